@@ -0,0 +1,239 @@
+#!/anaconda/bin/python3
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+import shopinfo as shopinfo_module
+from blocking import candidate_pairs, pair_distances
+from products import get_products
+
+
+shopinfo_tmpl = '''<?xml version="1.0" encoding="{encoding}"?>
+<ShopInfo>
+  <Name>Shop {num}</Name>
+  <Url>http://shop{num}.example.com</Url>
+  <Categories>
+    <TotalProductCount>{rows}</TotalProductCount>
+  </Categories>
+  <Tabular>
+    <CSV>
+      <Url>{base_url}/feeds/{num}.csv</Url>
+      <SpecialCharacters delimiter="{delimiter}" lineend="{lineend}"/>
+    </CSV>
+    <Mappings>
+      <Mapping column="0" columnName="ArtNr" type="privateid"/>
+      <Mapping column="1" columnName="Bezeichnung" type="name"/>
+      <Mapping column="2" columnName="Beschreibung" type="shortdescription"/>
+      <Mapping column="3" columnName="Hersteller" type="brand"/>
+      <Mapping column="4" columnName="EAN" type="ean"/>
+      <Mapping column="5" columnName="Preis" type="price"/>
+      <Mapping column="6" columnName="Kategorie" type="type"/>
+      <Mapping column="7" columnName="Langtext" type="description"/>
+    </Mappings>
+  </Tabular>
+</ShopInfo>
+'''
+
+brands = ['Samsung', 'Apple', 'Sony', 'Bosch', 'Canon', 'Miele', 'Philips']
+kinds = ['Fernseher', 'Smartphone', 'Kamera', 'Akkuschrauber',
+         'Waschmaschine', 'Kopfhörer']
+suffixes = ['', ' schwarz', ' weiß', ' OVP', ' (Neuware)', ' Größe M']
+
+
+def ean_with_check_digit(base):
+    digits = [int(d) for d in '{:012d}'.format(base)]
+    checksum = sum(d * (1 if i % 2 else 3)
+                   for i, d in enumerate(reversed(digits)))
+    return '{:012d}{}'.format(base, (10 - checksum % 10) % 10)
+
+
+class SyntheticShops:
+    """Generates shopinfo.xml files and feed csvs at a configurable
+    scale into `root/shopinfos` and `root/feeds`.
+    """
+    encodings = ['utf-8', 'latin1']
+    delimiters = [';', ',', '[tab]', '|']
+
+    def __init__(self, root, shops=10, rows=1000, catalogue=None,
+                 broken=0.01, seed=0):
+        self.root = root
+        self.shops = shops
+        self.rows = rows
+        self.catalogue = catalogue or rows * 2
+        self.broken = broken
+        self.random = random.Random(seed)
+
+    def product(self, num):
+        rnd = random.Random(num)
+        brand, kind = rnd.choice(brands), rnd.choice(kinds)
+        return {
+            'ean': ean_with_check_digit(400000000000 + num),
+            'name': '{} {} {}'.format(brand, kind, rnd.randint(100, 9999)),
+            'brand': brand,
+            'type': kind,
+            'price': rnd.uniform(5, 2000),
+        }
+
+    def feed_lines(self, delimiter):
+        rnd = self.random
+        for line_num, num in enumerate(
+                rnd.sample(range(self.catalogue), self.rows)):
+            product = self.product(num)
+            price = product['price'] * rnd.uniform(0.9, 1.1)
+            price = rnd.choice([
+                '{:.2f}'.format(price),
+                '{:,.2f}'.format(price).replace(',', 'X').replace(
+                    '.', ',').replace('X', '.'),
+                '{:.2f} EUR'.format(price).replace('.', ','),
+            ])
+            fields = [
+                str(num), product['name'] + rnd.choice(suffixes),
+                'Kurzbeschreibung {}'.format(product['name']),
+                product['brand'], product['ean'], price, product['type'],
+                'Langtext ' * rnd.randint(5, 50),
+            ]
+            # a broken first line would make pandas use the first
+            # column as index, keep the feeds comparable between runs
+            if line_num > 0 and rnd.random() < self.broken:
+                fields.append('kaputt')
+            yield delimiter.join(
+                '"{}"'.format(field) if delimiter in field else field
+                for field in fields)
+
+    def write(self, base_url):
+        for directory in ('shopinfos', 'feeds'):
+            os.makedirs(os.path.join(self.root, directory), exist_ok=True)
+        urls = []
+        for num in range(self.shops):
+            encoding = self.encodings[num % len(self.encodings)]
+            delimiter = self.delimiters[num % len(self.delimiters)]
+            lineend = '\\r\\n' if num % 3 == 0 else '\\n'
+            xml = shopinfo_tmpl.format(
+                num=num, encoding=encoding, rows=self.rows,
+                base_url=base_url, delimiter=delimiter, lineend=lineend)
+            path = os.path.join(self.root, 'shopinfos', '{}.xml'.format(num))
+            with open(path, 'w', encoding=encoding) as f:
+                f.write(xml)
+            real_delimiter = '\t' if delimiter == '[tab]' else delimiter
+            header = real_delimiter.join([
+                'ArtNr', 'Bezeichnung', 'Beschreibung', 'Hersteller', 'EAN',
+                'Preis', 'Kategorie', 'Langtext'])
+            newline = '\r\n' if num % 3 == 0 else '\n'
+            path = os.path.join(self.root, 'feeds', '{}.csv'.format(num))
+            with open(path, 'w', encoding=encoding, newline=newline) as f:
+                f.write(header + '\n')
+                for line in self.feed_lines(real_delimiter):
+                    f.write(line + '\n')
+            urls.append('{}/shopinfos/{}.xml'.format(base_url, num))
+        return urls
+
+
+class LocalServer:
+    """Serves a directory over http from a background thread."""
+    def __init__(self, directory):
+        handler = partial(QuietHandler, directory=directory)
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.httpd.server_port)
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class Timings:
+    def __init__(self):
+        self.stages = {}
+
+    def __call__(self, stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.stages[stage] = time.perf_counter() - start
+        return result
+
+
+def run_benchmark(shops=10, rows=1000, broken=0.01, match_rows=2000,
+                  seed=0):
+    timings = Timings()
+    with tempfile.TemporaryDirectory() as tmp:
+        serve_dir = os.path.join(tmp, 'serve')
+        work_dir = os.path.join(tmp, 'work')
+        os.makedirs(work_dir)
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            with LocalServer(serve_dir) as server:
+                generator = SyntheticShops(
+                    serve_dir, shops=shops, rows=rows, broken=broken,
+                    seed=seed)
+                urls = generator.write(server.url)
+                shopinfos = timings(
+                    'get_shopinfos_from_urls',
+                    shopinfo_module.get_shopinfos_from_urls, urls)
+                timings('get_feed_for_shopinfos',
+                        shopinfo_module.get_feed_for_shopinfos, shopinfos)
+            frames = timings('valid_ean_df', lambda: [
+                s.valid_ean_df for s in shopinfos])
+            timings('valid_ean_df_cached', lambda: [
+                s.valid_ean_df for s in shopinfos])
+            for s, df in zip(shopinfos, frames):
+                if df is not None:
+                    df.insert(0, 'shop', s.shop_key)
+            pd.concat([df for df in frames if df is not None]).to_csv(
+                'products.csv')
+            products = timings('get_products', get_products, 'products.csv')
+            sample = products.iloc[:match_rows]
+            pairs = timings('candidate_pairs', candidate_pairs, sample)
+            timings('pair_distances', pair_distances, sample, pairs)
+        finally:
+            os.chdir(cwd)
+    return {
+        'timestamp': time.time(),
+        'params': {'shops': shops, 'rows': rows, 'broken': broken,
+                   'match_rows': match_rows, 'seed': seed},
+        'counts': {'products': len(products), 'pairs': len(pairs)},
+        'seconds': timings.stages,
+    }
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description='crawl -> download -> parse -> match benchmark')
+    parser.add_argument('--shops', type=int, default=10)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--broken', type=float, default=0.01)
+    parser.add_argument('--match-rows', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.jsonl')
+    options = parser.parse_args(args)
+    result = run_benchmark(
+        shops=options.shops, rows=options.rows, broken=options.broken,
+        match_rows=options.match_rows, seed=options.seed)
+    with open(options.output, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
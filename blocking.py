@@ -0,0 +1,148 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from features import TextExtractor
+
+
+def _pairs_within_groups(order, groups, max_offset):
+    """Pairs (i, j) of rows which are at most `max_offset` apart in
+    `order` and share the same value in `groups` (given in `order`).
+    """
+    left, right = [], []
+    for offset in range(1, max_offset + 1):
+        same = groups[offset:] == groups[:-offset]
+        left.append(order[:-offset][same])
+        right.append(order[offset:][same])
+    if not left:
+        return np.empty((0, 2), dtype=np.int64)
+    pairs = np.column_stack([np.concatenate(left), np.concatenate(right)])
+    return np.sort(pairs, axis=1)
+
+
+def unique_pairs(pairs):
+    pairs = np.sort(np.asarray(pairs, dtype=np.int64), axis=1)
+    return np.unique(pairs, axis=0)
+
+
+class MinHashLSH:
+    """Candidate pairs from MinHash signatures over character n-grams.
+
+    Rows whose signatures agree on all values of at least one band end
+    up in the same bucket and become candidates. Buckets larger than
+    `max_bucket_size` are skipped, they are dominated by generic texts.
+    """
+    prime = (1 << 31) - 1
+
+    def __init__(self, num_perm=64, bands=16, ngram_range=(3, 3),
+                 max_bucket_size=100, random_state=0):
+        if num_perm % bands:
+            raise ValueError('num_perm must be a multiple of bands')
+        self.num_perm = num_perm
+        self.bands = bands
+        self.ngram_range = ngram_range
+        self.max_bucket_size = max_bucket_size
+        rng = np.random.RandomState(random_state)
+        self.a = rng.randint(1, self.prime, size=num_perm).astype(np.uint64)
+        self.b = rng.randint(0, self.prime, size=num_perm).astype(np.uint64)
+        self.shingler = HashingVectorizer(
+            analyzer='char_wb', ngram_range=ngram_range, n_features=2 ** 24,
+            binary=True, norm=None, alternate_sign=False)
+
+    def signatures(self, texts):
+        shingles = self.shingler.transform(texts).tocsr()
+        num_rows = shingles.shape[0]
+        signatures = np.full((num_rows, self.num_perm), self.prime,
+                             dtype=np.uint64)
+        non_empty = np.flatnonzero(np.diff(shingles.indptr))
+        if len(non_empty) == 0:
+            return signatures
+        starts = shingles.indptr[non_empty]
+        indices = shingles.indices.astype(np.uint64)
+        for k in range(self.num_perm):
+            hashed = (self.a[k] * indices + self.b[k]) % self.prime
+            signatures[non_empty, k] = np.minimum.reduceat(hashed, starts)
+        return signatures
+
+    def candidate_pairs(self, texts):
+        signatures = self.signatures(texts)
+        rows = signatures.shape[1] // self.bands
+        multipliers = np.uint64(0x9E3779B97F4A7C15) ** np.arange(
+            rows, dtype=np.uint64)
+        pairs = []
+        for band in range(self.bands):
+            band_values = signatures[:, band * rows:(band + 1) * rows]
+            keys = (band_values * multipliers).sum(axis=1)
+            order = np.argsort(keys, kind='mergesort')
+            keys = keys[order]
+            # bucket ids in sorted order, drop oversized buckets
+            starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+            sizes = np.diff(np.r_[starts, len(keys)])
+            bucket = np.repeat(np.arange(len(starts)), sizes)
+            bucket_sizes = sizes[bucket]
+            keep = bucket_sizes <= self.max_bucket_size
+            max_offset = int(bucket_sizes[keep].max(initial=1)) - 1
+            bucket = np.where(keep, bucket, -1 - np.arange(len(bucket)))
+            pairs.append(_pairs_within_groups(order, bucket, max_offset))
+        return unique_pairs(np.concatenate(pairs))
+
+
+def price_window_pairs(prices, window=5):
+    """Sorted neighbourhood over price: each offer is paired with the
+    next `window` offers in price order.
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    order = np.argsort(prices, kind='mergesort')
+    groups = np.zeros(len(order), dtype=np.int64)
+    window = min(window, max(len(order) - 1, 0))
+    return _pairs_within_groups(order, groups, window)
+
+
+def candidate_pairs(products, text_cols=['name', 'brand'], lsh=None,
+                    price_window=5):
+    """Candidate pairs (positions into `products`) from MinHash LSH over
+    the text columns, combined with a sorted window over price.
+    """
+    lsh = lsh or MinHashLSH()
+    texts = TextExtractor(text_cols=text_cols).transform(products)
+    pairs = [lsh.candidate_pairs(texts)]
+    if price_window:
+        pairs.append(price_window_pairs(products.price, window=price_window))
+    return unique_pairs(np.concatenate(pairs))
+
+
+def _row_cosine(X, left, right):
+    # rows of tfidf matrices are l2 normalized, so the dot product
+    # is the cosine similarity
+    return np.asarray(X[left].multiply(X[right]).sum(axis=1)).ravel()
+
+
+def pair_distances(products, pairs):
+    """Cosine, ngram and price distances like in the notebooks, but only
+    for the given candidate pairs instead of all n**2 pairs.
+    """
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    left, right = pairs[:, 0], pairs[:, 1]
+
+    texts = TextExtractor(text_cols=['name', 'brand', 'type']).transform(
+        products)
+    tfidf = TfidfVectorizer().fit_transform(texts).tocsr()
+
+    whitespace = re.compile('[^0-9a-zA-Z]+')
+    names = (whitespace.sub('', text) for text in
+             TextExtractor(text_cols=['name']).transform(products))
+    ngrams = TfidfVectorizer(analyzer='char_wb', ngram_range=(2, 5)
+                             ).fit_transform(names).tocsr()
+
+    prices = np.asarray(products.price, dtype=np.float64)
+    return pd.DataFrame({
+        'i': left,
+        'j': right,
+        'cosine': 1.0 - _row_cosine(tfidf, left, right),
+        'ngram': 1.0 - _row_cosine(ngrams, left, right),
+        'price': np.abs(prices[left] - prices[right]),
+    })
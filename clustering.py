@@ -0,0 +1,145 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+
+def combined_distances(distances, columns=['price', 'cosine', 'ngram']):
+    """ The combined distance of the notebooks (euclidean norm of the
+        min/max scaled price and the text distances, min/max scaled),
+        for the pairs of a `blocking.pair_distances` frame.
+    """
+    def min_max(values):
+        values = np.asarray(values, dtype=np.float64)
+        spread = values.max() - values.min() if len(values) else 0.0
+        return (values - values.min()) / spread if spread else \
+            np.zeros_like(values)
+
+    parts = distances[columns].astype(np.float64)
+    if 'price' in parts:
+        parts['price'] = min_max(parts['price'])
+    combined = np.sqrt(np.square(parts).sum(axis=1))
+    return pd.Series(min_max(combined), index=distances.index)
+
+
+class UnionFind:
+    """Disjoint sets over 0..n-1 with union by size and path halving."""
+    def __init__(self, n):
+        self.parent = np.arange(n, dtype=np.int64)
+        self.size = np.ones(n, dtype=np.int64)
+
+    def find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, a, b):
+        """ Merges the sets of a and b, returns the new root """
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return a
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+        return a
+
+    def labels(self):
+        # follow all parent pointers at once until every node is at its root
+        roots = self.parent
+        while True:
+            grand = roots[roots]
+            if np.array_equal(grand, roots):
+                break
+            roots = grand
+        return pd.factorize(roots, sort=False)[0]
+
+
+def _thresholded(edges, threshold, distance):
+    edges = edges[edges[distance] < threshold] if threshold is not None \
+        else edges
+    return (edges.i.to_numpy(dtype=np.int64),
+            edges.j.to_numpy(dtype=np.int64),
+            edges[distance].to_numpy(dtype=np.float64))
+
+
+def cluster_edges(n, edges, threshold=0.7, distance='combined',
+                  max_size=None, cannot_link=None):
+    """ Clusters n offers given a sparse edge list (a frame with columns
+        i, j and `distance`). Offers are linked if their distance is
+        below `threshold`, clusters are the connected components.
+        Returns cluster labels 0..k-1 per offer.
+
+        Single linkage tends to chain unrelated offers into huge
+        clusters via a few borderline edges. With `max_size` or
+        `cannot_link` (e.g. the shop of each offer, a shop rarely lists
+        the same product twice) edges are added closest first and
+        skipped if the merged cluster would break a guard.
+    """
+    left, right, dist = _thresholded(edges, threshold, distance)
+    if max_size is None and cannot_link is None:
+        graph = sparse.coo_matrix(
+            (np.ones(len(left), dtype=np.int8), (left, right)),
+            shape=(n, n))
+        return connected_components(graph, directed=False)[1]
+
+    uf = UnionFind(n)
+    members = None
+    if cannot_link is not None:
+        codes = pd.factorize(np.asarray(cannot_link), sort=False)[0]
+        members = {i: {code} for i, code in enumerate(codes)}
+    for k in np.argsort(dist, kind='mergesort'):
+        a, b = uf.find(left[k]), uf.find(right[k])
+        if a == b:
+            continue
+        if max_size is not None and uf.size[a] + uf.size[b] > max_size:
+            continue
+        if members is not None:
+            if not members[a].isdisjoint(members[b]):
+                continue
+            root = uf.union(a, b)
+            other = b if root == a else a
+            members[root] |= members.pop(other)
+        else:
+            uf.union(a, b)
+    return uf.labels()
+
+
+def iter_node_link_json(n, edge_chunks, threshold=0.7, distance='combined',
+                        node_attrs=None):
+    """ Yields a networkx style node-link json document in pieces, one
+        piece per node and per edge below `threshold`, so the graph is
+        never built in memory. `edge_chunks` is a frame or an iterable of
+        frames like `cluster_edges` takes, `node_attrs` maps attribute
+        names (e.g. 'color') to per node values.
+    """
+    if isinstance(edge_chunks, pd.DataFrame):
+        edge_chunks = [edge_chunks]
+    node_attrs = node_attrs or {}
+    yield '{"directed": false, "multigraph": false, "graph": {}, "nodes": ['
+    for i in range(n):
+        node = {'id': i}
+        for name, values in node_attrs.items():
+            value = values[i]
+            node[name] = value.item() if isinstance(value, np.generic) \
+                else value
+        yield ('' if i == 0 else ', ') + json.dumps(node)
+    yield '], "links": ['
+    first = True
+    for edges in edge_chunks:
+        for i, j, d in zip(*_thresholded(edges, threshold, distance)):
+            link = {'source': int(i), 'target': int(j), 'distance': float(d)}
+            yield ('' if first else ', ') + json.dumps(link)
+            first = False
+    yield ']}'
+
+
+def write_node_link_json(path, n, edge_chunks, **kwargs):
+    with open(path, 'w') as f:
+        for piece in iter_node_link_json(n, edge_chunks, **kwargs):
+            f.write(piece)
@@ -0,0 +1,134 @@
+import asyncio
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from xml.etree.ElementTree import ParseError
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from elmar import ElmarPage
+from shopinfo import Shopinfo
+
+
+class Crawler:
+    """Run blocking shopinfo/elmar jobs from an asyncio event loop.
+
+    All jobs share one `requests.Session`, so connections to a host are
+    kept alive and reused instead of doing a new TCP/TLS handshake per
+    request. `concurrency` limits the number of requests in flight
+    overall and `per_host` the number of requests to a single host.
+    Errors are handled by the wrapped methods themselves, so they are
+    classified exactly like in the threaded code path.
+    """
+    def __init__(self, concurrency=50, per_host=4):
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=concurrency,
+                              pool_maxsize=per_host)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def host_for(self, url):
+        try:
+            return urlparse(url).netloc
+        except (AttributeError, ValueError):
+            return None
+
+    async def _run_jobs(self, jobs):
+        loop = asyncio.get_running_loop()
+        limit = asyncio.Semaphore(self.concurrency)
+        host_limits = defaultdict(lambda: asyncio.Semaphore(self.per_host))
+
+        async def run_job(url, func):
+            # wait for the host before taking a global slot, so jobs
+            # queued for a busy host don't block the other hosts
+            async with host_limits[self.host_for(url)], limit:
+                return await loop.run_in_executor(executor, func)
+
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            return await asyncio.gather(
+                *(run_job(url, func) for url, func in jobs),
+                return_exceptions=True)
+
+    def run(self, jobs):
+        """ Runs (url, callable) jobs and returns their results in order,
+            exceptions raised by a job are returned as its result.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self._run_jobs(jobs))
+        # called from a running loop (e.g. jupyter), which can't be
+        # nested, use a private loop in a helper thread
+        with ThreadPoolExecutor(1) as helper:
+            return helper.submit(asyncio.run, self._run_jobs(jobs)).result()
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_shopinfos_from_urls(shopinfo_urls, concurrency=50, per_host=4,
+                            metrics=None):
+    """ Drop-in for shopinfo.get_shopinfos_from_urls """
+    with Crawler(concurrency=concurrency, per_host=per_host) as crawler:
+        shopinfos = [Shopinfo(url, session=crawler.session, metrics=metrics)
+                     for url in shopinfo_urls]
+        crawler.run([(s.url, s.download_shopinfo_xml) for s in shopinfos])
+    for shopinfo in shopinfos:
+        shopinfo.session = None
+        shopinfo.metrics = None
+    return shopinfos
+
+
+def _csv_url_or_none(shopinfo):
+    try:
+        return shopinfo.csv_url
+    except (ParseError, requests.exceptions.RequestException):
+        return None
+
+
+def get_feed_for_shopinfos(shopinfos, concurrency=50, per_host=4,
+                           metrics=None):
+    """ Drop-in for shopinfo.get_feed_for_shopinfos """
+    with Crawler(concurrency=concurrency, per_host=per_host) as crawler:
+        for shopinfo in shopinfos:
+            shopinfo.session = crawler.session
+            if metrics is not None:
+                shopinfo.metrics = metrics
+        try:
+            crawler.run([(_csv_url_or_none(s), s.download_feed_csv)
+                         for s in shopinfos])
+        finally:
+            for shopinfo in shopinfos:
+                shopinfo.session = None
+                shopinfo.metrics = None
+    return shopinfos
+
+
+def get_shopinfo_urls(shopcount, blocksize, concurrency=10, per_host=4,
+                      url_tmpl=None):
+    """ Drop-in for elmar.get_shopinfo_urls """
+    pages = int((shopcount / blocksize) + 1)
+    with Crawler(concurrency=concurrency, per_host=per_host) as crawler:
+        elmar_pages = [
+            ElmarPage(page, blocksize, session=crawler.session,
+                      url_tmpl=url_tmpl)
+            for page in range(1, pages + 1)]
+        results = crawler.run(
+            [(p.url, lambda p=p: p.shopinfo_urls) for p in elmar_pages])
+    shopinfo_urls = []
+    for page, result in zip(elmar_pages, results):
+        if isinstance(result, Exception):
+            print('{}: {}'.format(result.__class__.__name__, page.url))
+            continue
+        shopinfo_urls.extend(result)
+    return shopinfo_urls
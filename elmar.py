@@ -2,7 +2,10 @@
 
 import os
 import re
+import json
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
 from queue import Queue
 from threading import Thread
@@ -19,14 +22,22 @@ class ElmarPage:
     line_pattern = re.compile('a.target.*counter.*home')
     url_pattern = re.compile(r'redirect=(?P<url>http.*)&amp;rid=2"')
 
-    def __init__(self, page, blocksize, elmar_dir='elmar'):
+    def __init__(self, page, blocksize, elmar_dir='elmar', session=None,
+                 url_tmpl=None):
         self.page = page
         self.blocksize = blocksize
         self.elmar_dir = elmar_dir
+        self.session = session
         self.path = os.path.join(
             self.elmar_dir, '{}_{}.txt'.format(self.page, self.blocksize))
+        if url_tmpl is not None:
+            self.url_tmpl = url_tmpl
         self.url = self.url_tmpl.format(page, blocksize)
 
+    @property
+    def http(self):
+        return self.session if self.session is not None else requests
+
     def get_shopinfo_url_from_line(self, line):
         line = unquote(line)
         m = self.url_pattern.search(line)
@@ -39,7 +50,11 @@ class ElmarPage:
 
     def fetch_shopinfo_urls(self):
         shopinfo_urls = []
-        r = requests.get(self.url)
+        r = self.http.get(self.url)
+        if r.status_code != requests.codes.ok:
+            # an error page would look like the empty end of the listing
+            raise requests.exceptions.HTTPError(
+                'http {}: {}'.format(r.status_code, self.url), response=r)
         for line in StringIO(r.content.decode('utf8')):
             line = line.rstrip()
             m = self.line_pattern.search(line)
@@ -52,14 +67,22 @@ class ElmarPage:
         if not os.path.exists(self.elmar_dir):
             os.makedirs(self.elmar_dir)
         shopinfo_urls = self.fetch_shopinfo_urls()
-        with open(self.path, 'w') as f:
+        if not shopinfo_urls:
+            # past the end of the listing, which may grow, don't cache
+            return False
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
             for shopinfo_url in shopinfo_urls:
                 f.write('{}\n'.format(shopinfo_url))
+        os.replace(tmp_path, self.path)
+        return True
 
     @property
     def shopinfo_urls(self):
-        if not os.path.exists(self.path):
-            self.download_page()
+        # empty files are left over from older crawls, fetch them again
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            if not self.download_page():
+                return []
         shopinfo_urls = []
         with open(self.path, 'r') as f:
             for line in f:
@@ -76,7 +99,12 @@ class ElmarWorker(Thread):
     def run(self):
         while True:
             elmar_page = self.job_queue.get()
-            self.result_queue.put(elmar_page.shopinfo_urls)
+            try:
+                shopinfo_urls = elmar_page.shopinfo_urls
+            except requests.exceptions.RequestException as e:
+                print('{}: {}'.format(e.__class__.__name__, elmar_page.url))
+                shopinfo_urls = []
+            self.result_queue.put(shopinfo_urls)
             self.job_queue.task_done()
 
 
@@ -104,3 +132,110 @@ def get_shopinfo_urls(shopcount, blocksize):
 
     job_queue.join()
     return results
+
+
+class ElmarCrawl:
+    """Crawls the elmar shop listing without knowing the shop count.
+
+    Pages are fetched `workers` at a time ahead of the consumer and
+    processed in order until the first empty page, which marks the end
+    of the listing. Iterating yields each shopinfo url once, as soon as
+    its page arrives. The listing entries are cached in order in
+    `listing.txt` and the checkpoint holds how many of them are
+    complete. Both count shops rather than pages, so an interrupted
+    crawl resumes without refetching what it has, even with another
+    blocksize. A finished crawl only probes the page after its last
+    entry, in case the listing grew. Pages which can't be fetched
+    raise, the checkpoint stays at the page before.
+    """
+    def __init__(self, blocksize=50, elmar_dir='elmar', workers=10,
+                 session=None, url_tmpl=None):
+        self.blocksize = blocksize
+        self.elmar_dir = elmar_dir
+        self.workers = workers
+        self.session = session
+        self.url_tmpl = url_tmpl
+        self.listing_path = os.path.join(elmar_dir, 'listing.txt')
+        self.checkpoint_path = os.path.join(elmar_dir, 'checkpoint.json')
+
+    def load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return {'shops': 0, 'size': 0, 'finished': False}
+        with open(self.checkpoint_path, 'r') as f:
+            return json.load(f)
+
+    def save_checkpoint(self, shops, size, finished=False):
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'shops': shops, 'size': size, 'finished': finished},
+                      f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def page(self, num):
+        return ElmarPage(num, self.blocksize, elmar_dir=self.elmar_dir,
+                         session=self.session, url_tmpl=self.url_tmpl)
+
+    def cached_urls(self, checkpoint):
+        """ The listing entries up to the checkpoint, entries written
+            after it (by an interrupted crawl) are cut off """
+        if not os.path.exists(self.listing_path):
+            return []
+        with open(self.listing_path, 'r+b') as f:
+            f.truncate(checkpoint['size'])
+            return f.read().decode('utf8').splitlines()
+
+    def __iter__(self):
+        seen = set()
+
+        def new_urls(shopinfo_urls):
+            for url in shopinfo_urls:
+                if url and url != 'None' and url not in seen:
+                    seen.add(url)
+                    yield url
+
+        if not os.path.exists(self.elmar_dir):
+            os.makedirs(self.elmar_dir)
+        checkpoint = self.load_checkpoint()
+        cached = self.cached_urls(checkpoint)
+        yield from new_urls(cached)
+        shops, size = len(cached), checkpoint['size']
+
+        # the page holding the first uncached shop, without its cached
+        # entries
+        next_page, skip = divmod(shops, self.blocksize)
+        next_page += 1
+        with ThreadPoolExecutor(self.workers) as executor, \
+                open(self.listing_path, 'ab') as listing:
+            pending = deque()
+
+            def fetch_ahead(pages):
+                nonlocal next_page
+                while len(pending) < pages:
+                    pending.append(executor.submit(
+                        lambda num: self.page(num).fetch_shopinfo_urls(),
+                        next_page))
+                    next_page += 1
+
+            fetch_ahead(1 if checkpoint['finished'] else self.workers)
+            while pending:
+                shopinfo_urls = pending.popleft().result()[skip:]
+                skip = 0
+                if len(shopinfo_urls) == 0:
+                    for future in pending:
+                        future.cancel()
+                    self.save_checkpoint(shops, size, finished=True)
+                    return
+                lines = ''.join('{}\n'.format(url) for url in shopinfo_urls)
+                listing.write(lines.encode('utf8'))
+                listing.flush()
+                shops, size = shops + len(shopinfo_urls), listing.tell()
+                self.save_checkpoint(shops, size)
+                yield from new_urls(shopinfo_urls)
+                fetch_ahead(self.workers)
+
+
+def iter_shopinfo_urls(blocksize=50, **kwargs):
+    """ Streams deduplicated shopinfo urls from the elmar listing, see
+        ElmarCrawl.
+    """
+    return iter(ElmarCrawl(blocksize=blocksize, **kwargs))
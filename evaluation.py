@@ -0,0 +1,153 @@
+import numpy as np
+import pandas as pd
+
+from scipy import sparse
+
+
+class Contingency:
+    """Sparse contingency table of true vs. predicted labels.
+
+    Only the non empty cells are kept, so memory is O(n) however many
+    eans or clusters there are. All scores are computed from the cell
+    counts and the row/column sums, without enumerating pairs.
+    """
+    def __init__(self, true, predicted):
+        true_codes, self.true_labels = pd.factorize(
+            pd.Series(true), sort=False)
+        predicted_codes, self.predicted_labels = pd.factorize(
+            pd.Series(predicted), sort=False)
+        if (true_codes < 0).any() or (predicted_codes < 0).any():
+            raise ValueError('labels must not be missing')
+        self.n = len(true_codes)
+        table = sparse.coo_matrix(
+            (np.ones(self.n, dtype=np.int64), (true_codes, predicted_codes)),
+            shape=(len(self.true_labels), len(self.predicted_labels)))
+        table.sum_duplicates()
+        self.rows = table.row
+        self.cols = table.col
+        self.counts = table.data
+        self.true_sizes = np.bincount(
+            true_codes, minlength=len(self.true_labels))
+        self.predicted_sizes = np.bincount(
+            predicted_codes, minlength=len(self.predicted_labels))
+
+
+def _pairs(counts):
+    counts = counts.astype(np.int64)
+    return int((counts * (counts - 1) // 2).sum())
+
+
+def _entropy(sizes, n):
+    p = sizes[sizes > 0] / n
+    return float(-(p * np.log(p)).sum())
+
+
+def pairwise_scores(contingency):
+    """ Precision, recall and f1 over all unordered pairs of offers, a
+        pair being a match if both offers have the same label.
+    """
+    c = contingency
+    tp = _pairs(c.counts)
+    predicted_pairs = _pairs(c.predicted_sizes)
+    true_pairs = _pairs(c.true_sizes)
+    fp = predicted_pairs - tp
+    fn = true_pairs - tp
+    tn = c.n * (c.n - 1) // 2 - tp - fp - fn
+    precision = tp / predicted_pairs if predicted_pairs else 1.0
+    recall = tp / true_pairs if true_pairs else 1.0
+    f1 = 2 * precision * recall / (precision + recall) \
+        if precision + recall else 0.0
+    return {'tp': tp, 'fp': fp, 'fn': fn, 'tn': tn, 'precision': precision,
+            'recall': recall, 'f1': f1}
+
+
+def entropy_scores(contingency):
+    """ Homogeneity, completeness and V-measure, same values as
+        sklearn.metrics.homogeneity_completeness_v_measure.
+    """
+    c = contingency
+    h_true = _entropy(c.true_sizes, c.n)
+    h_predicted = _entropy(c.predicted_sizes, c.n)
+    counts = c.counts.astype(np.float64)
+    outer = c.true_sizes[c.rows].astype(np.float64) * \
+        c.predicted_sizes[c.cols]
+    mutual_info = float((counts / c.n * (
+        np.log(counts * c.n) - np.log(outer))).sum())
+    homogeneity = mutual_info / h_true if h_true else 1.0
+    completeness = mutual_info / h_predicted if h_predicted else 1.0
+    v_measure = 2 * homogeneity * completeness / \
+        (homogeneity + completeness) if homogeneity + completeness else 0.0
+    return {'homogeneity': homogeneity, 'completeness': completeness,
+            'v_measure': v_measure}
+
+
+def _errors(labels, sizes, groups, others, counts, other_labels):
+    """ Per label of one side of the table: size, number of labels of
+        the other side it's spread over, the dominant one and the pairs
+        within the label which don't share the other label.
+    """
+    order = np.lexsort((-counts, groups))
+    groups, others, counts = groups[order], others[order], counts[order]
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    spread = np.diff(np.r_[starts, len(groups)])
+    ids = groups[starts]
+    pair_counts = counts.astype(np.int64) * (counts - 1) // 2
+    agreeing_pairs = np.add.reduceat(pair_counts, starts)
+    group_sizes = sizes[ids].astype(np.int64)
+    return pd.DataFrame({
+        'label': np.asarray(labels)[ids],
+        'size': group_sizes,
+        'spread': spread,
+        'majority': np.asarray(other_labels)[others[starts]],
+        'majority_size': counts[starts],
+        'wrong_pairs': group_sizes * (group_sizes - 1) // 2 - agreeing_pairs,
+    })
+
+
+def cluster_errors(contingency):
+    """ Error breakdown per predicted cluster. `spread` is the number of
+        eans mixed into the cluster and `wrong_pairs` the false positive
+        pairs it contributes. Worst clusters first.
+    """
+    c = contingency
+    errors = _errors(c.predicted_labels, c.predicted_sizes, c.cols,
+                     c.rows, c.counts, c.true_labels)
+    errors = errors.rename(columns={'label': 'cluster', 'majority': 'ean'})
+    return errors.sort_values('wrong_pairs', ascending=False,
+                              kind='mergesort').reset_index(drop=True)
+
+
+def ean_errors(contingency):
+    """ Error breakdown per ean. `spread` is the number of clusters the
+        eans offers were split into and `wrong_pairs` the false negative
+        pairs it contributes. Worst eans first.
+    """
+    c = contingency
+    errors = _errors(c.true_labels, c.true_sizes, c.rows, c.cols,
+                     c.counts, c.predicted_labels)
+    errors = errors.rename(columns={'label': 'ean', 'majority': 'cluster'})
+    return errors.sort_values('wrong_pairs', ascending=False,
+                              kind='mergesort').reset_index(drop=True)
+
+
+def evaluate(true, predicted):
+    """ All pairwise and entropy based scores for predicted cluster
+        labels, with the eans as ground truth.
+    """
+    contingency = Contingency(true, predicted)
+    scores = pairwise_scores(contingency)
+    scores.update(entropy_scores(contingency))
+    return scores
+
+
+def evaluate_products(products, predicted='predicted', true='ean'):
+    return evaluate(products[true], products[predicted])
+
+
+def print_scores(scores):
+    print('Pairwise precision: %0.3f' % scores['precision'])
+    print('Pairwise recall: %0.3f' % scores['recall'])
+    print('Pairwise f1: %0.3f' % scores['f1'])
+    print('Homogeneity: %0.3f' % scores['homogeneity'])
+    print('Completeness: %0.3f' % scores['completeness'])
+    print('V-measure: %0.3f' % scores['v_measure'])
@@ -1,5 +1,11 @@
+import numpy as np
+
+from joblib import Parallel, delayed
+from scipy import sparse
 from sklearn.base import BaseEstimator
 from sklearn.base import TransformerMixin
+from sklearn.pipeline import Pipeline
+from sklearn.feature_extraction.text import HashingVectorizer
 
 
 class EmptyFitMixin:
@@ -17,8 +23,87 @@ class TextExtractor(BaseEstimator, TransformerMixin, EmptyFitMixin):
         self.text_cols = text_cols
     
     def transform(self, data):
-        def join(items):
-            return ' '.join([str(item) for item in items])
-        
-        texts = data[self.text_cols].apply(join, axis=1)
+        # astype(str) renders missing values like str() does ('nan'),
+        # so the texts are the same as from joining row by row
+        texts = data[self.text_cols[0]].astype(str)
+        for col in self.text_cols[1:]:
+            texts = texts + ' ' + data[col].astype(str)
         return texts
+
+
+def make_hashing_features(text_cols=['name', 'brand', 'type'],
+                          n_features=2 ** 20, **kwargs):
+    """Stateless alternative to TextExtractor + TfidfVectorizer.
+
+    There is no vocabulary to fit, so each chunk or shop can be
+    transformed on its own (see `transform_chunks`) and the results
+    stacked. Rows are l2 normalized, like tf-idf rows.
+    """
+    return Pipeline([
+        ('text', TextExtractor(text_cols=text_cols)),
+        ('hashing', HashingVectorizer(
+            n_features=n_features, alternate_sign=False, **kwargs)),
+    ])
+
+
+def transform_chunks(transformer, chunks, n_jobs=1):
+    """ Transforms chunks (e.g. per shop dataframes) in parallel with a
+        stateless transformer and stacks the resulting rows.
+    """
+    parts = Parallel(n_jobs=n_jobs)(
+        delayed(transformer.transform)(chunk) for chunk in chunks)
+    return sparse.vstack(parts, format='csr')
+
+
+def _top_k_block(X_block, X_T, offset, k, threshold, include_self):
+    similarities = (X_block @ X_T).tocsr()
+    similarities.sum_duplicates()
+    rows = np.repeat(np.arange(similarities.shape[0]),
+                     np.diff(similarities.indptr))
+    cols, data = similarities.indices, similarities.data
+    keep = np.ones(len(data), dtype=bool)
+    if not include_self:
+        keep &= cols != rows + offset
+    if threshold is not None:
+        keep &= data >= threshold
+    rows, cols, data = rows[keep], cols[keep], data[keep]
+    if k is not None:
+        # rank entries within each row by descending similarity
+        order = np.lexsort((-data, rows))
+        rows, cols, data = rows[order], cols[order], data[order]
+        row_starts = np.searchsorted(rows, rows, side='left')
+        keep = np.arange(len(rows)) - row_starts < k
+        rows, cols, data = rows[keep], cols[keep], data[keep]
+    return sparse.csr_matrix((data, (rows, cols)), shape=similarities.shape)
+
+
+class TopKCosineNeighbors(BaseEstimator, TransformerMixin, EmptyFitMixin):
+    """Sparse replacement for a dense cosine distance matrix.
+
+    Takes l2 normalized rows (e.g. from `TfidfVectorizer`) and computes
+    the cosine similarities blockwise, keeping only the `k` most similar
+    rows (and/or those with a similarity >= `threshold`) per row. Memory
+    is bounded by `block_size` rows at a time. Returns a sparse n x n
+    matrix of similarities, missing entries mean no similarity (the
+    distance is 1 - similarity).
+    """
+    def __init__(self, k=10, threshold=None, block_size=1000, n_jobs=1,
+                 include_self=True):
+        self.k = k
+        self.threshold = threshold
+        self.block_size = block_size
+        self.n_jobs = n_jobs
+        self.include_self = include_self
+
+    def transform(self, X):
+        X = sparse.csr_matrix(X)
+        X_T = X.T.tocsc()
+        blocks = range(0, X.shape[0], self.block_size)
+        parts = Parallel(n_jobs=self.n_jobs)(
+            delayed(_top_k_block)(
+                X[start:start + self.block_size], X_T, start, self.k,
+                self.threshold, self.include_self)
+            for start in blocks)
+        if not parts:
+            return sparse.csr_matrix((0, X.shape[0]))
+        return sparse.vstack(parts, format='csr')
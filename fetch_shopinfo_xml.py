@@ -7,15 +7,13 @@ import sys
 import requests
 
 from io import StringIO
-from joblib import Memory
 from joblib import Parallel, delayed
 
 from urllib.parse import unquote
 from xml.etree.ElementTree import ParseError
 
 from shopinfo import Shopinfo
-
-memory = Memory(cachedir='cache')
+from store import default_store
 
 
 def generate_elmar_urls(shopcount, blocksize):
@@ -36,7 +34,7 @@ def get_shopinfo_url_from_line(line, pattern):
         return url
 
 
-@memory.cache
+@default_store.cache
 def get_shopinfo_urls_from_page(elmar_url):
     line_pattern = re.compile('a.target.*counter.*home')
     url_pattern = re.compile(r'redirect=(?P<url>http.*)&amp;rid=2"')
@@ -52,25 +50,6 @@ def get_shopinfo_urls_from_page(elmar_url):
     return shopinfo_urls
 
 
-@memory.cache
-def get_shopinfo_xml_from_url(shopinfo_url):
-    content = None
-    try:
-        r = requests.get(shopinfo_url, timeout=10)
-        if r.status_code == requests.codes.ok:
-            if len(r.content) > 0:
-                content = r.content
-    except requests.exceptions.ConnectionError:
-        print('connection aborted: {}'.format(shopinfo_url))
-    except requests.exceptions.InvalidSchema:
-        print('invalid schema: {}'.format(shopinfo_url))
-    except requests.exceptions.TooManyRedirects:
-        print('too many redirects: {}'.format(shopinfo_url))
-    except requests.exceptions.InvalidURL:
-        print('invalid url: {}'.format(shopinfo_url))
-    return content
-
-
 def shopinfo_url_generator():
     num = 0
     #for elmar_url in generate_elmar_urls(4633, 50):
@@ -83,16 +62,14 @@ def shopinfo_url_generator():
 
 
 def get_shopinfo(shopinfo_url):
-    shopinfo = None
-    shopinfo_xml = get_shopinfo_xml_from_url(shopinfo_url)
-    #print(shopinfo_xml)
-    if shopinfo_xml is not None:
-        try:
-            shopinfo = Shopinfo(shopinfo_xml)
-        except ParseError:
-            print('parse_error: {}'.format(shopinfo_url))
-        except AttributeError:
-            print('root node is None: {}'.format(shopinfo_url))
+    # the xml is kept in the artifact store, keyed by its url
+    shopinfo = Shopinfo(shopinfo_url)
+    shopinfo.download_shopinfo_xml()
+    try:
+        shopinfo.root
+    except ParseError:
+        print('parse_error: {}'.format(shopinfo_url))
+        shopinfo = None
     return shopinfo
 
 
@@ -0,0 +1,86 @@
+#!/anaconda/bin/python3
+
+import os
+import sys
+import shutil
+
+from joblib import Parallel, delayed
+
+from shopinfo import Shopinfo
+
+
+product_columns = ['shop', 'shop_name'] + Shopinfo.columns
+
+
+def ingest_shop(url, shop_id, parts_dir):
+    """ Parses and ean validates the feed of one shop and writes the
+        valid rows to a headerless part file. Returns a report dict.
+        The feed is looked up by the urls shop_key, so shop_id is only a
+        label and the order of the urls doesn't matter.
+    """
+    shopinfo = Shopinfo(url, shop_id=shop_id)
+    report = {'shop': shopinfo.shop_key, 'shop_id': shop_id, 'url': url,
+              'parsed': 0, 'kept': 0, 'error': None, 'part': None}
+    try:
+        df = shopinfo.dataframe
+        if df is None:
+            report['error'] = 'unparseable'
+            return report
+        report['parsed'] = len(df)
+        df.ean, valid = shopinfo.ean.norm_array(df.ean)
+        df = df[valid]
+        df.insert(0, 'shop_name', shopinfo.name)
+        df.insert(0, 'shop', shopinfo.shop_key)
+        report['kept'] = len(df)
+        part = os.path.join(parts_dir, '{}.csv'.format(shopinfo.shop_key))
+        df[product_columns].to_csv(part, header=False)
+        report['part'] = part
+    except Exception as e:
+        report['error'] = e.__class__.__name__
+    return report
+
+
+def ingest(shopinfo_urls, csv_name='products.csv', parts_dir='parts',
+           n_jobs=-1):
+    """ Builds the combined products table from all downloaded feeds,
+        parsing the feeds in a process pool. Returns per shop reports.
+    """
+    if not os.path.exists(parts_dir):
+        os.makedirs(parts_dir)
+    # a url listed twice would write the same part file twice
+    shopinfo_urls = list(dict.fromkeys(shopinfo_urls))
+    reports = Parallel(n_jobs=n_jobs)(
+        delayed(ingest_shop)(url, shop_id, parts_dir)
+        for shop_id, url in enumerate(shopinfo_urls))
+    with open(csv_name, 'w') as out:
+        # leading empty column for the index, like DataFrame.to_csv
+        out.write(',{}\n'.format(','.join(product_columns)))
+        for report in reports:
+            if report['part'] is not None:
+                with open(report['part'], 'r') as part:
+                    shutil.copyfileobj(part, out)
+                os.remove(report['part'])
+    return reports
+
+
+def print_report(reports):
+    failures = [r for r in reports if r['error'] is not None]
+    for r in sorted(reports, key=lambda r: r['kept'], reverse=True):
+        if r['error'] is None:
+            print('{shop} {parsed:>9} {kept:>9} {url}'.format(**r))
+    for r in failures:
+        print('failed: {shop} {error} {url}'.format(**r))
+    print('shops: {} failed: {} rows: {}'.format(
+        len(reports), len(failures), sum(r['kept'] for r in reports)))
+
+
+def main(args):
+    urls_name = args[0]
+    csv_name = args[1] if len(args) > 1 else 'products.csv'
+    with open(urls_name, 'r') as f:
+        shopinfo_urls = [line.rstrip() for line in f if line.strip()]
+    print_report(ingest(shopinfo_urls, csv_name=csv_name))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,156 @@
+import numpy as np
+import pandas as pd
+import joblib
+
+from collections import Counter
+
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.preprocessing import normalize
+
+from clustering import cluster_edges
+from features import TextExtractor, TopKCosineNeighbors
+from products import offer_keys
+
+
+class MatchIndex:
+    """Persistent product clusters new offers can be matched against.
+
+    `build` fits the tf-idf vectorizer on all offers, clusters them
+    (top k cosine neighbours + `cluster_edges`) and keeps the l2
+    normalized centroid of each cluster as its representative. The
+    transposed representatives are a sparse inverted index: a query
+    only touches the clusters sharing a term with it.
+
+    `update` assigns new or changed offers to the closest cluster if
+    its distance is below `threshold`, the rest are clustered among
+    themselves and open new clusters. That costs time in the size of
+    the delta, but the vocabulary and the centroids of existing
+    clusters stay as they were, so `build` should be rerun from time
+    to time. Offers are identified by `products.offer_keys`, or by the
+    values of `key_cols` if given.
+    """
+    def __init__(self, text_cols=['name', 'brand', 'type'], threshold=0.3,
+                 k=10, max_size=None, key_cols=None):
+        self.text_cols = text_cols
+        self.threshold = threshold
+        self.k = k
+        self.max_size = max_size
+        self.key_cols = key_cols
+
+    def _keys(self, products):
+        # indexes saved before key_cols defaulted to None lack it
+        return offer_keys(products, getattr(self, 'key_cols', None))
+
+    def _vectors(self, products):
+        texts = TextExtractor(text_cols=self.text_cols).transform(products)
+        return self.vectorizer.transform(texts)
+
+    def _cluster(self, X):
+        """ Cluster labels 0..k-1 for the rows of X """
+        similarities = TopKCosineNeighbors(
+            k=self.k, threshold=1.0 - self.threshold,
+            include_self=False).transform(X).tocoo()
+        edges = pd.DataFrame({
+            'i': similarities.row, 'j': similarities.col,
+            'distance': 1.0 - similarities.data})
+        return cluster_edges(X.shape[0], edges, threshold=self.threshold,
+                             distance='distance', max_size=self.max_size)
+
+    @staticmethod
+    def _centroids(X, labels):
+        n_clusters = labels.max() + 1 if len(labels) else 0
+        members = sparse.csr_matrix(
+            (np.ones(len(labels)), (labels, np.arange(len(labels)))),
+            shape=(n_clusters, X.shape[0]))
+        return normalize(members @ X).tocsr()
+
+    def build(self, products):
+        """ Full rebuild from all offers, returns their cluster labels """
+        texts = TextExtractor(text_cols=self.text_cols).transform(products)
+        self.vectorizer = TfidfVectorizer().fit(texts)
+        X = self.vectorizer.transform(texts)
+        labels = self._cluster(X)
+        self.representatives = self._centroids(X, labels)
+        self._index = self.representatives.T.tocsc()
+        self.new_representatives = []
+        self._new_index = None
+        self.n_clusters = self.representatives.shape[0]
+        keys = self._keys(products)
+        self.assignments = dict(zip(keys, labels.tolist()))
+        self.sizes = Counter(self.assignments.values())
+        return pd.Series(labels, index=products.index)
+
+    def _best_clusters(self, X):
+        """ Closest cluster and its similarity per row, -1 if none """
+        best = np.full(X.shape[0], -1, dtype=np.int64)
+        best_similarity = np.zeros(X.shape[0])
+        for offset, index in ((0, self._index),
+                              (self.representatives.shape[0],
+                               self._new_index)):
+            if index is None or index.shape[1] == 0:
+                continue
+            similarities = (X @ index).tocsr()
+            clusters = np.asarray(similarities.argmax(axis=1)).ravel()
+            values = similarities.max(axis=1).toarray().ravel()
+            better = values > best_similarity
+            best[better] = clusters[better] + offset
+            best_similarity[better] = values[better]
+        return best, best_similarity
+
+    def _assign(self, key, cluster):
+        previous = self.assignments.get(key)
+        if previous is not None:
+            self.sizes[previous] -= 1
+        self.assignments[key] = cluster
+        self.sizes[cluster] += 1
+
+    def update(self, products):
+        """ Assigns new or changed offers to clusters, returns their
+            cluster labels.
+        """
+        keys = self._keys(products).tolist()
+        X = self._vectors(products)
+        best, similarity = self._best_clusters(X)
+        labels = np.full(len(keys), -1, dtype=np.int64)
+        for row in np.flatnonzero(
+                (best >= 0) & (similarity > 1.0 - self.threshold)):
+            cluster = best[row]
+            if self.max_size is not None and \
+                    self.sizes[cluster] >= self.max_size and \
+                    self.assignments.get(keys[row]) != cluster:
+                continue
+            labels[row] = cluster
+            self._assign(keys[row], cluster)
+
+        unmatched = np.flatnonzero(labels < 0)
+        if len(unmatched):
+            X_new = X[unmatched]
+            new_labels = self._cluster(X_new)
+            self.new_representatives.append(
+                self._centroids(X_new, new_labels))
+            self._new_index = sparse.vstack(
+                self.new_representatives, format='csr').T.tocsc()
+            new_labels = new_labels + self.n_clusters
+            self.n_clusters = new_labels.max() + 1
+            for row, cluster in zip(unmatched, new_labels.tolist()):
+                labels[row] = cluster
+                self._assign(keys[row], cluster)
+        return pd.Series(labels, index=products.index)
+
+    def remove(self, keys):
+        """ Forgets offers (e.g. removed from their feed) """
+        for key in keys:
+            cluster = self.assignments.pop(key, None)
+            if cluster is not None:
+                self.sizes[cluster] -= 1
+
+    def labels(self):
+        return pd.Series(self.assignments, name='cluster')
+
+    def save(self, path):
+        joblib.dump(self, path)
+
+    @classmethod
+    def load(cls, path):
+        return joblib.load(path)
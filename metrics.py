@@ -0,0 +1,102 @@
+import json
+import time
+
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from threading import Lock
+
+
+class StageRecord:
+    """What happened for one shop in one stage (shopinfo, feed, parse)."""
+    __slots__ = (
+        'shop_id', 'url', 'stage', 'seconds', 'bytes', 'rows_parsed',
+        'rows_kept', 'encoding_fallback', 'error', 'message',
+    )
+
+    def __init__(self, shop_id=None, url=None, stage=None):
+        for field in self.__slots__:
+            setattr(self, field, None)
+        self.shop_id = shop_id
+        self.url = url
+        self.stage = stage
+        self.bytes = 0
+        self.encoding_fallback = False
+
+    def fail(self, error, message=None):
+        self.error = error
+        self.message = message
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+class Metrics:
+    """Thread safe collector of per shop and stage records.
+
+    Pass an instance as `metrics` to `get_shopinfos_from_urls` or
+    `get_feed_for_shopinfos` and call `report()` afterwards.
+    """
+    def __init__(self):
+        self.records = []
+        self.lock = Lock()
+
+    @contextmanager
+    def stage(self, shopinfo, stage):
+        record = StageRecord(shopinfo.shop_id, shopinfo.url, stage)
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            if record.error is None:
+                record.fail(e.__class__.__name__, str(e))
+            raise
+        finally:
+            record.seconds = time.perf_counter() - start
+            with self.lock:
+                self.records.append(record)
+
+    def report(self, slowest=10):
+        """ Aggregates the records to the slowest shops, throughput per
+            stage and a histogram of failures per stage.
+        """
+        stages = defaultdict(lambda: {
+            'shops': 0, 'seconds': 0.0, 'bytes': 0, 'rows_parsed': 0,
+            'rows_kept': 0, 'encoding_fallbacks': 0, 'failures': 0})
+        failures = defaultdict(Counter)
+        with self.lock:
+            records = list(self.records)
+        for record in records:
+            stage = stages[record.stage]
+            stage['shops'] += 1
+            stage['seconds'] += record.seconds
+            stage['bytes'] += record.bytes or 0
+            stage['rows_parsed'] += record.rows_parsed or 0
+            stage['rows_kept'] += record.rows_kept or 0
+            stage['encoding_fallbacks'] += int(record.encoding_fallback)
+            if record.error is not None:
+                stage['failures'] += 1
+                failures[record.stage][record.error] += 1
+        for stage in stages.values():
+            seconds = stage['seconds'] or float('nan')
+            stage['bytes_per_second'] = stage['bytes'] / seconds
+            stage['rows_per_second'] = stage['rows_parsed'] / seconds
+        slowest_records = sorted(
+            records, key=lambda r: r.seconds, reverse=True)[:slowest]
+        return {
+            'stages': dict(stages),
+            'failures': {k: dict(v) for k, v in failures.items()},
+            'slowest': [r.as_dict() for r in slowest_records],
+        }
+
+    def export(self, path):
+        """ Writes all records as json lines. """
+        with self.lock:
+            records = list(self.records)
+        with open(path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record.as_dict()) + '\n')
+
+
+@contextmanager
+def null_stage(shopinfo, stage):
+    yield StageRecord(shopinfo.shop_id, shopinfo.url, stage)
@@ -0,0 +1,214 @@
+import multiprocessing
+import os
+
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from shopinfo import Shopinfo
+
+
+# end of input marker passed from stage to stage
+_done = object()
+
+
+def _put(queue, item, stop):
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+class PipelineStage:
+    """Worker threads applying `func` to the shopinfos of a bounded queue.
+
+    If `func` returns something truthy the shopinfo is handed on to
+    `next_stage`, otherwise it's finished and put on `results` with a
+    None dataframe. The last stage (without `next_stage`) puts the
+    shopinfo together with the return value of `func` on `results`.
+    Putting into a full queue blocks, so a slow stage holds back the
+    stages in front of it instead of buffering all shops. Once `stop`
+    is set the workers drop what they hold and exit.
+    """
+    def __init__(self, name, func, workers, results, next_stage=None,
+                 maxsize=100, stop=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.results = results
+        self.next_stage = next_stage
+        self.queue = Queue(maxsize)
+        self.running = workers
+        self.lock = Lock()
+        self.stop = stop if stop is not None else Event()
+
+    def start(self):
+        for _ in range(self.workers):
+            worker = Thread(target=self.run)
+            worker.daemon = True
+            worker.start()
+
+    def finish(self):
+        """ Called by each worker on the end marker, the last one passes
+            it on to the next stage (once per worker) or the results.
+        """
+        with self.lock:
+            self.running -= 1
+            last = self.running == 0
+        if last:
+            if self.next_stage is None:
+                self.put(self.results, _done)
+            else:
+                for _ in range(self.next_stage.workers):
+                    self.put(self.next_stage.queue, _done)
+
+    def put(self, queue, item):
+        """ Blocks while queue is full, False if stopped meanwhile """
+        return _put(queue, item, self.stop)
+
+    def get(self):
+        """ Next item of the queue, None if stopped meanwhile """
+        while not self.stop.is_set():
+            try:
+                return self.queue.get(timeout=0.1)
+            except Empty:
+                pass
+
+    def run(self):
+        while True:
+            shopinfo = self.get()
+            if shopinfo is None:
+                return
+            if shopinfo is _done:
+                self.finish()
+                return
+            try:
+                result = self.func(shopinfo)
+            except BrokenExecutor as e:
+                # not a problem of this shop, no other shop will get
+                # through either, hand the error to the consumer
+                self.put(self.results, e)
+                self.stop.set()
+                return
+            except Exception as e:
+                # recorded by the metrics stage, if any, keep working
+                if shopinfo.metrics is None:
+                    print('{}: {} {}'.format(
+                        e.__class__.__name__, shopinfo.url, shopinfo.shop_id))
+                self.put(self.results, (shopinfo, None))
+                continue
+            if self.next_stage is None:
+                self.put(self.results, (shopinfo, result))
+            elif result:
+                self.put(self.next_stage.queue, shopinfo)
+            else:
+                self.put(self.results, (shopinfo, None))
+
+
+
+def fetch_shopinfo(shopinfo):
+    shopinfo.download_shopinfo_xml()
+    return True
+
+
+def wants_feed(shopinfo):
+    meta = shopinfo.meta
+    return bool(meta.has_ean) and meta.csv_url is not None
+
+
+def download_feed(shopinfo):
+    return shopinfo.download_feed_csv() is not None
+
+
+def parse_valid_ean_df(url, shop_id, store):
+    """ Runs in a worker process, the feed is found in the store by url """
+    return Shopinfo(url, shop_id=shop_id, store=store).valid_ean_df
+
+
+class ParseStage:
+    """Stage function handing the parsing to a process pool."""
+    def __init__(self, executor):
+        self.executor = executor
+
+    def __call__(self, shopinfo):
+        with shopinfo._stage('parse') as record:
+            df = self.executor.submit(
+                parse_valid_ean_df, shopinfo.url, shopinfo.shop_id,
+                shopinfo.store).result()
+            if df is not None:
+                record.rows_kept = len(df)
+        return df
+
+
+def iter_pipeline(shopinfo_urls, fetch_workers=20, download_workers=10,
+                  parse_processes=None, queue_size=100, metrics=None):
+    """ Fetches shopinfos, keeps those with ean and csv url, downloads
+        their feeds and parses them, with all stages running at the same
+        time. Yields (shopinfo, valid_ean_df) as soon as a shop is done,
+        valid_ean_df is None for shops which were dropped or failed.
+        A broken parse pool stops the pipeline and is raised.
+    """
+    parse_processes = parse_processes or os.cpu_count()
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=fetch_workers + download_workers,
+                          pool_maxsize=max(fetch_workers, download_workers))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    results = Queue(queue_size)
+    stop = Event()
+    # forked workers would inherit the locks held by the running threads
+    executor = ProcessPoolExecutor(
+        parse_processes, mp_context=multiprocessing.get_context('forkserver'))
+    parse = PipelineStage(
+        'parse', ParseStage(executor), parse_processes, results,
+        maxsize=queue_size, stop=stop)
+    download = PipelineStage(
+        'download', download_feed, download_workers, results,
+        next_stage=parse, maxsize=queue_size, stop=stop)
+    filter_ = PipelineStage(
+        'filter', wants_feed, 1, results, next_stage=download,
+        maxsize=queue_size, stop=stop)
+    fetch = PipelineStage(
+        'fetch', fetch_shopinfo, fetch_workers, results,
+        next_stage=filter_, maxsize=queue_size, stop=stop)
+    for stage in (parse, download, filter_, fetch):
+        stage.start()
+
+    def feed():
+        for shopinfo_url in shopinfo_urls:
+            if not _put(fetch.queue, Shopinfo(
+                    shopinfo_url, session=session, metrics=metrics), stop):
+                return
+        for _ in range(fetch.workers):
+            _put(fetch.queue, _done, stop)
+
+    feeder = Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+    try:
+        while True:
+            item = results.get()
+            if item is _done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            shopinfo, df = item
+            shopinfo.session = None
+            shopinfo.metrics = None
+            yield shopinfo, df
+    finally:
+        # the consumer may stop early, stop the stages and drop queued parses
+        stop.set()
+        executor.shutdown(cancel_futures=True)
+        session.close()
+
+def run_pipeline(shopinfo_urls, **kwargs):
+    """ Like iter_pipeline, but returns all (shopinfo, df) pairs """
+    return list(iter_pipeline(shopinfo_urls, **kwargs))
@@ -0,0 +1,144 @@
+#!/anaconda/bin/python3
+
+import sys
+import json
+
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+from products import get_products
+from util import Ean
+
+
+class PriceIndex:
+    """Price comparison queries over the products table.
+
+    Offers are sorted by (ean, price) once, so all offers for an ean
+    are a contiguous, price ordered slice found by binary search. The
+    per ean aggregates (min/median/max price, offer count, cheapest
+    shop) are precomputed from that order. Results for hot eans are
+    kept in an LRU cache.
+    """
+    offer_columns = ['shop', 'name', 'price']
+
+    def __init__(self, products, cache_size=10000):
+        eans, valid = Ean().parse_array(products.ean)
+        products = products[valid]
+        eans = eans[valid]
+        order = np.lexsort((products.price.to_numpy(), eans))
+        self.eans = eans[order]
+        self.prices = products.price.to_numpy(dtype=np.float64)[order]
+        self.offers_table = products.iloc[order][
+            [c for c in self.offer_columns if c in products]]
+
+        starts = np.flatnonzero(
+            np.r_[True, self.eans[1:] != self.eans[:-1]])
+        self.unique_eans = self.eans[starts]
+        self.offsets = np.r_[starts, len(self.eans)]
+        counts = np.diff(self.offsets)
+        lower = starts + (counts - 1) // 2
+        upper = starts + counts // 2
+        self.aggregates = {
+            'min': self.prices[starts],
+            'median': (self.prices[lower] + self.prices[upper]) / 2,
+            'max': self.prices[self.offsets[1:] - 1],
+            'offers': counts,
+            'cheapest_shop': (self.offers_table['shop'].to_numpy()[starts]
+                              if 'shop' in self.offers_table else None),
+        }
+        self.offers = lru_cache(maxsize=cache_size)(self._offers)
+        self.summary = lru_cache(maxsize=cache_size)(self._summary)
+
+    def _position(self, ean):
+        try:
+            ean = int(str(ean).strip())
+        except ValueError:
+            return None
+        i = np.searchsorted(self.unique_eans, ean)
+        if i == len(self.unique_eans) or self.unique_eans[i] != ean:
+            return None
+        return i
+
+    def _offers(self, ean):
+        """ all offers for an ean, cheapest first """
+        i = self._position(ean)
+        if i is None:
+            return []
+        offers = self.offers_table.iloc[self.offsets[i]:self.offsets[i + 1]]
+        return json.loads(offers.to_json(orient='records'))
+
+    def _summary(self, ean):
+        i = self._position(ean)
+        if i is None:
+            return None
+        summary = {'ean': str(self.unique_eans[i])}
+        for key, values in self.aggregates.items():
+            if values is not None:
+                value = values[i]
+                if isinstance(value, np.generic):
+                    value = value.item()
+                summary[key] = value
+        return summary
+
+    def cheapest(self, ean, n=10):
+        """ the n cheapest offers for an ean """
+        return self.offers(ean)[:n]
+
+
+class PriceRequestHandler(BaseHTTPRequestHandler):
+    """ GET /offers/<ean>, /cheapest/<ean>?n=10 and /summary/<ean> """
+    index = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        if len(parts) != 2:
+            return self.respond(404, {'error': 'not found'})
+        route, ean = parts
+        if route == 'offers':
+            result = self.index.offers(ean)
+        elif route == 'cheapest':
+            try:
+                n = int(parse_qs(url.query).get('n', ['10'])[0])
+            except ValueError:
+                return self.respond(400, {'error': 'n must be an integer'})
+            result = self.index.cheapest(ean, n=n)
+        elif route == 'summary':
+            result = self.index.summary(ean)
+        else:
+            return self.respond(404, {'error': 'not found'})
+        if not result:
+            return self.respond(404, {'error': 'unknown ean'})
+        self.respond(200, result)
+
+    def respond(self, status, data):
+        body = json.dumps(data).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_server(index, host='127.0.0.1', port=8000):
+    handler = type('Handler', (PriceRequestHandler,), {'index': index})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main(args):
+    csv_name = args[0] if args else 'products.csv'
+    port = int(args[1]) if len(args) > 1 else 8000
+    index = PriceIndex(get_products(csv_name=csv_name))
+    server = make_server(index, port=port)
+    print('serving {} eans on port {}'.format(len(index.unique_eans), port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
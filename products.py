@@ -1,7 +1,11 @@
+import os
+
+import numpy as np
 import pandas as pd
 
 from random import sample
-from collections import defaultdict
+
+from util import Ean
 
 
 def convert_price(price):
@@ -21,27 +25,233 @@ def convert_price(price):
         return None
 
 
-def get_products(csv_name='products.csv'):
-    """ get products dataframe from csv"""
-    products = pd.read_csv(
-        csv_name, error_bad_lines=False, converters={'price': convert_price},
-        low_memory=False)
+def convert_prices(prices):
+    """ vectorized convert_price for a whole column, unparseable
+        prices become nan"""
+    prices = pd.Series(prices).astype(str)
+    has_comma = prices.str.contains(',', regex=False)
+    prices = prices.where(
+        ~has_comma,
+        prices.str.replace('.', '', regex=False).str.replace(
+            ',', '.', regex=False))
+    prices = prices.str.replace(' EUR', '', regex=False)
+    return pd.to_numeric(prices, errors='coerce')
+
+
+def unparseable_prices(raw_prices, prices, shops):
+    """ count of prices per shop which were given but couldn't be
+        converted"""
+    unparseable = raw_prices.notnull() & prices.isnull()
+    counts = unparseable.groupby(shops).sum()
+    return counts[counts > 0].sort_values(ascending=False)
+
+
+def as_text(values):
+    """ a column as the strings of the feed, whatever dtype read_csv
+        inferred: a missing value makes ids float (123 -> 123.0), whole
+        floats are turned back into ints. Missing values stay nan."""
+    values = pd.Series(values)
+    if pd.api.types.infer_dtype(values, skipna=True) in ('string', 'empty'):
+        return values
+    text = values.astype(str)
+    if values.dtype.kind == 'f':
+        whole = values.notnull() & (np.modf(values.fillna(0))[0] == 0)
+        text[whole] = values[whole].astype(np.int64).astype(str)
+    return text.where(values.notnull())
+
+
+def offer_keys(products, key_cols=None):
+    """ identifies an offer across feed refreshes by shop and privateid,
+        offers without a privateid by shop and ean. With key_cols by the
+        values of those columns instead."""
+    if key_cols is not None:
+        keys = as_text(products[key_cols[0]]).astype(str)
+        for col in key_cols[1:]:
+            keys = keys + '/' + as_text(products[col]).astype(str)
+        return keys
+    privateids = as_text(products.privateid)
+    ids = privateids.where(
+        privateids.notnull(), 'ean:' + as_text(products.ean).astype(str))
+    return as_text(products.shop) + '/' + ids
+
+
+# dtypes for the compact loading mode, eans become uint64 and prices
+# float32 after parsing
+compact_dtypes = {
+    'shop': 'category',
+    'shop_name': 'category',
+    'brand': 'category',
+    'type': 'category',
+    'ean': str,
+    'price': str,
+}
+
+# long text columns which are only loaded on demand in compact mode
+description_columns = ['shortdescription']
+
+
+def get_products(csv_name='products.csv', report_prices=False,
+                 compact=False):
+    """ get products dataframe from csv
+
+        With compact=True eans are stored as uint64 (rows without a
+        parseable ean are dropped), low cardinality columns as
+        categoricals, prices as float32 and description columns are
+        left out (see load_descriptions)."""
+    if compact:
+        products = pd.read_csv(
+            csv_name, error_bad_lines=False, dtype=compact_dtypes,
+            usecols=lambda c: c not in description_columns)
+    else:
+        products = pd.read_csv(
+            csv_name, error_bad_lines=False, dtype={'price': str},
+            low_memory=False)
     products = products.drop('Unnamed: 0', 1)
+    raw_prices = products.price
+    products['price'] = convert_prices(raw_prices)
+    if report_prices:
+        print('unparseable prices per shop:')
+        print(unparseable_prices(raw_prices, products.price, products.shop))
     products = products[~products.price.isnull()]
+    if compact:
+        eans, valid = Ean().parse_array(products.ean)
+        products = products[valid].assign(
+            ean=eans[valid].astype(np.uint64),
+            price=products.price[valid].astype(np.float32))
     return products
 
 
+def load_descriptions(products, csv_name='products.csv',
+                      columns=description_columns, chunksize=100000):
+    """ lazily load description columns for (a subset of) products
+        loaded with compact=True, aligned by row index. The csv is read
+        in chunks and only the wanted rows are kept."""
+    wanted = products.index
+    chunks = pd.read_csv(
+        csv_name, error_bad_lines=False, usecols=columns,
+        dtype={c: str for c in columns}, chunksize=chunksize)
+    descriptions = pd.concat(
+        [chunk[chunk.index.isin(wanted)] for chunk in chunks])
+    return descriptions.reindex(wanted)
+
+
+def memory_savings(products):
+    """ memory used per column by the compact products frame compared
+        to the same column stored as python objects, in bytes"""
+    usage = []
+    for col in products.columns:
+        compact = products[col].memory_usage(deep=True, index=False)
+        expanded = products[col].astype(object)
+        if col == 'ean':
+            expanded = expanded.astype(str)
+        usage.append((col, compact, expanded.memory_usage(
+            deep=True, index=False)))
+    usage = pd.DataFrame(usage, columns=['column', 'compact', 'expanded'])
+    usage['saved'] = usage.expanded - usage.compact
+    return usage.set_index('column')
+
+
+class EanIndex:
+    """Inverted index from each ean to the rows and shops offering it.
+
+    Row positions are stored grouped by ean (CSR style), so looking up
+    all offers for an ean or the eans offered by more than n shops
+    doesn't need to rescan the products table. Positions refer to the
+    products frame the index was built from (use them with `iloc`).
+    """
+    def __init__(self, eans, offsets, positions, shop_counts, num_rows):
+        self.eans = eans
+        self.offsets = offsets
+        self.positions = positions
+        self.shop_counts = shop_counts
+        self.num_rows = num_rows
+
+    @classmethod
+    def from_products(cls, products):
+        codes, eans = pd.factorize(products.ean, sort=True)
+        known = codes >= 0
+        positions = np.arange(len(codes))[known]
+        codes = codes[known]
+        order = np.argsort(codes, kind='mergesort')
+        counts = np.bincount(codes, minlength=len(eans))
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        shop_counts = products.shop.groupby(
+            products.ean.to_numpy()).nunique().reindex(eans).to_numpy()
+        eans = np.asarray(eans)
+        if eans.dtype == object:
+            eans = eans.astype(str)
+        return cls(eans, offsets, positions[order], shop_counts,
+                   len(products))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['eans'], data['offsets'], data['positions'],
+                   data['shop_counts'], int(data['num_rows']))
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, eans=self.eans, offsets=self.offsets,
+                     positions=self.positions, shop_counts=self.shop_counts,
+                     num_rows=self.num_rows)
+
+    @classmethod
+    def for_csv(cls, csv_name, products):
+        """ load the index stored next to csv_name or (re)build it if
+            it's missing or outdated"""
+        path = '{}.eanindex.npz'.format(csv_name)
+        if os.path.exists(path) and \
+                os.path.getmtime(path) >= os.path.getmtime(csv_name):
+            index = cls.load(path)
+            if index.num_rows == len(products):
+                return index
+        index = cls.from_products(products)
+        index.save(path)
+        return index
+
+    def eans_in_more_than(self, n):
+        """ eans offered by more than n shops"""
+        return self.eans[self.shop_counts > n]
+
+    def _query(self, ean):
+        """ ean as the type of the indexed eans, None if it can't be """
+        kind = self.eans.dtype.kind
+        try:
+            if kind in 'iu':
+                return int(str(ean).strip())
+            if kind == 'f':
+                return float(str(ean).strip())
+        except ValueError:
+            return None
+        return str(ean).strip()
+
+    def offer_positions(self, ean):
+        ean = self._query(ean)
+        if ean is None:
+            return self.positions[:0]
+        i = np.searchsorted(self.eans, ean)
+        if i == len(self.eans) or self.eans[i] != ean:
+            return self.positions[:0]
+        return self.positions[self.offsets[i]:self.offsets[i + 1]]
+
+    def offers(self, products, ean):
+        """ all offers for this ean"""
+        return products.iloc[self.offer_positions(ean)]
+
+    def sample_positions(self, n, sample_size):
+        """ row positions of sample_size random eans offered by more
+            than n shops"""
+        good = np.flatnonzero(self.shop_counts > n)
+        picked = sample(list(good), sample_size)
+        positions = [self.positions[self.offsets[i]:self.offsets[i + 1]]
+                     for i in picked]
+        return np.sort(np.concatenate(positions))
+
+
 def get_products_from_different_shops(
     csv_name='products.csv', n=5, sample_size=10):
     """ select only eans which appear in more than n shops"""
     products = get_products(csv_name=csv_name)
-    shops_for_ean = defaultdict(set)
-
-    for ean, shop in zip(products.ean, products.shop):
-        shops_for_ean[ean].add(shop)
-
-    good_eans = list(
-        {ean for ean, shops in shops_for_ean.items() if len(shops) > n})
-    sample_eans = sample(good_eans, sample_size)
-    sample_products = products[products.ean.isin(pd.Series(sample_eans))]
+    index = EanIndex.for_csv(csv_name, products)
+    sample_products = products.iloc[index.sample_positions(n, sample_size)]
     return sample_products
@@ -1,5 +1,11 @@
 import os
 import re
+import csv
+import glob
+import json
+import mmap
+import codecs
+import hashlib
 
 from queue import Queue
 from threading import Thread
@@ -10,6 +16,8 @@ import numpy as np
 import pandas as pd
 
 from util import Ean
+from metrics import StageRecord, null_stage
+from store import default_store
 
 
 class Shopinfo:
@@ -23,74 +31,246 @@ class Shopinfo:
         'type',
     ]
 
+    # feed columns are read as text, eans and ids would lose leading
+    # zeros or precision otherwise
+    dtypes = {col: str for col in columns}
+
+    chunksize = 100000
+
+    download_chunk_size = 2 ** 20
+
+    # bytes of the feed inspected to sniff its dialect
+    sniff_size = 2 ** 16
+    sniff_delimiters = [';', ',', '\t', '|']
+
+    encoding_pattern = re.compile(b'encoding="(?P<encoding>.*?)"')
+
     cls_shop_id = 0
 
-    def __init__(self, url, feed_dir='feeds',
-                 shopinfo_dir='shopinfos'):
+    def __init__(self, url, session=None, shop_id=None, metrics=None,
+                 store=None):
         self.url = url
-        self.feed_dir = feed_dir
-        self.shopinfo_dir = shopinfo_dir
+        self.session = session
+        self.metrics = metrics
+        # files are addressed by shop_key, shop_id is only a label
+        self.store = store if store is not None else default_store
         self.ean = Ean()
-        self.shop_id = Shopinfo.cls_shop_id
-        Shopinfo.cls_shop_id += 1
+        if shop_id is None:
+            shop_id = Shopinfo.cls_shop_id
+            Shopinfo.cls_shop_id += 1
+        self.shop_id = shop_id
+
+    def __getstate__(self):
+        # shopinfos are sent to process pools, the session's connections
+        # and the metrics collector (which holds a lock) stay behind
+        state = self.__dict__.copy()
+        state['session'] = None
+        state['metrics'] = None
+        return state
+
+    @property
+    def http(self):
+        # a shared requests.Session reuses keep-alive connections
+        return self.session if self.session is not None else requests
+
+    def _stage(self, stage):
+        if self.metrics is None:
+            return null_stage(self, stage)
+        return self.metrics.stage(self, stage)
+
+    def _failed(self, record, error, message):
+        # without a metrics collector failures are only printed
+        record.fail(error, message)
+        if self.metrics is None:
+            print(message)
+
+    @property
+    def shop_key(self):
+        """ Identifies the shop independent of the crawl order """
+        return hashlib.sha1(self.url.encode()).hexdigest()[:12]
 
     @property
     def feed_path(self):
-        feed_name = '{}.csv'.format(self.shop_id)
-        feed_path = os.path.join(self.feed_dir, feed_name)
-        return feed_path
+        return self.store.path(self.shop_key, '.csv')
+
+    @property
+    def parsed_key(self):
+        """ Changes whenever the feed file or the mapping config changes """
+        stat = os.stat(self.feed_path)
+        config = (stat.st_size, stat.st_mtime_ns, self.encoding,
+                  self.csv_delimiter, self.mappings, self.columns)
+        return hashlib.sha1(repr(config).encode()).hexdigest()[:16]
+
+    @property
+    def parsed_path(self):
+        return self.store.path(
+            self.shop_key, '.{}.feather'.format(self.parsed_key))
 
     @property
     def path(self):
-        name = '{}.xml'.format(self.shop_id)
-        path = os.path.join(self.shopinfo_dir, name)
-        return path
+        return self.store.path(self.shop_key, '.xml')
 
-    def _get_shopinfo_from_url(self):
+    def _get_shopinfo_from_url(self, record=None):
+        record = record or StageRecord()
         content = None
+        errors = [
+            (requests.exceptions.ConnectionError, 'connection aborted'),
+            (requests.exceptions.InvalidSchema, 'invalid schema'),
+            (requests.exceptions.TooManyRedirects, 'too many redirects'),
+            (requests.exceptions.InvalidURL, 'invalid url'),
+            (requests.exceptions.ReadTimeout, 'read timeout'),
+            (requests.packages.urllib3.exceptions.LocationParseError,
+             'broken url'),
+        ]
         try:
-            r = requests.get(self.url, timeout=10)
+            r = self.http.get(self.url, timeout=10)
             if r.status_code == requests.codes.ok:
                 if len(r.content) > 0:
                     content = r.content
-        except requests.exceptions.ConnectionError:
-            print('connection aborted: {} {}'.format(
-                self.url, self.shop_id))
-        except requests.exceptions.InvalidSchema:
-            print('invalid schema: {} {}'.format(
-                self.url, self.shop_id))
-        except requests.exceptions.TooManyRedirects:
-            print('too many redirects: {} {}'.format(
-                self.url, self.shop_id))
-        except requests.exceptions.InvalidURL:
-            print('invalid url: {} {}'.format(
-                self.url, self.shop_id))
-        except requests.exceptions.ReadTimeout:
-            print('read timeout: {} {}'.format(
-                self.url, self.shop_id))
-        except requests.packages.urllib3.exceptions.LocationParseError:
-            print('broken url: {} {}'.format(
-                self.url, self.shop_id))
+                    record.bytes = len(content)
+            else:
+                record.fail('http {}'.format(r.status_code))
+        except tuple(error for error, _ in errors) as e:
+            # first match wins, like the order of except clauses
+            error = next(name for cls, name in errors if isinstance(e, cls))
+            self._failed(record, error, '{}: {} {}'.format(
+                error, self.url, self.shop_id))
         return content
 
     def download_shopinfo_xml(self):
+        if self.store.lookup(self.path):
+            return
+        with self.store.lock(self.path):
+            # another process may have fetched it while we waited
+            if os.path.exists(self.path):
+                return
+            with self._stage('shopinfo') as record:
+                shopinfo_str = self._get_shopinfo_from_url(record)
+            self.store.write(self.path, shopinfo_str or b'')
+            if shopinfo_str is not None:
+                self._save_validators(self.path)
+
+    # cached state derived from the shopinfo xml
+    _derived_attrs = ('_shopinfo_str', '_root', '_mappings',
+                      '_column_lookup_dict', '_schars', '_meta')
+
+    def _clear_derived(self):
+        for attr in self._derived_attrs:
+            if hasattr(self, attr):
+                delattr(self, attr)
+
+    @staticmethod
+    def _file_sha1(path, blocksize=2 ** 20):
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(blocksize), b''):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+    def _load_validators(self, path):
+        try:
+            with open(path + '.validators', 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_validators(self, path, response=None):
+        validators = {'sha1': self._file_sha1(path)}
+        if response is not None:
+            validators['etag'] = response.headers.get('ETag')
+            validators['last_modified'] = response.headers.get(
+                'Last-Modified')
+        self.store.write(path + '.validators',
+                         json.dumps(validators).encode('utf8'))
+
+    def _conditional_refresh(self, url, path, stage):
+        """ Refetches url into path if it changed, using the stored
+            ETag/Last-Modified for a conditional request and the content
+            hash to detect unchanged full responses. The file is only
+            replaced (and so gets a new mtime) if its content changed.
+            Returns True if it did.
+        """
+        # serialized with downloads and other refreshes of the entry, the
+        # validators are loaded under the lock
+        with self.store.lock(path):
+            validators = self._load_validators(path)
+            headers = {'Accept-Encoding': 'gzip, deflate'}
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+            tmp_path = '{}.{}.refresh'.format(path, os.getpid())
+            with self._stage(stage) as record:
+                try:
+                    r = self.http.get(url, stream=True, headers=headers,
+                                      timeout=(10, 60))
+                    if r.status_code == requests.codes.not_modified:
+                        r.close()
+                        return False
+                    if r.status_code != requests.codes.ok:
+                        r.close()
+                        self._failed(record, 'http {}'.format(r.status_code),
+                                     'http {}: {} {}'.format(
+                                         r.status_code, url, self.shop_id))
+                        return False
+                    with open(tmp_path, 'wb') as f:
+                        for chunk in r.iter_content(
+                                chunk_size=self.download_chunk_size):
+                            if chunk:
+                                f.write(chunk)
+                                record.bytes += len(chunk)
+                except requests.exceptions.RequestException as e:
+                    error = e.__class__.__name__
+                    self._failed(record, error, '{}: {} {}'.format(
+                        error, url, self.shop_id))
+                    return False
+            changed = self._file_sha1(tmp_path) != validators.get('sha1')
+            if changed:
+                os.replace(tmp_path, path)
+                self.store.added(path)
+            else:
+                os.remove(tmp_path)
+            self._save_validators(path, r)
+            return changed
+
+    def refresh_shopinfo_xml(self):
+        """ Refreshes the shopinfo xml, sets and returns shopinfo_changed """
         if not os.path.exists(self.path):
-            if not os.path.exists(self.shopinfo_dir):
-                os.makedirs(self.shopinfo_dir)
-            shopinfo_str = self._get_shopinfo_from_url()
-            with open(self.path, 'wb') as f:
-                if shopinfo_str is not None:
-                    f.write(shopinfo_str)
-                else:
-                    f.write(b'')
+            self.download_shopinfo_xml()
+            self.shopinfo_changed = True
+        else:
+            self.shopinfo_changed = self._conditional_refresh(
+                self.url, self.path, 'refresh_shopinfo')
+        if self.shopinfo_changed:
+            self._clear_derived()
+        return self.shopinfo_changed
+
+    def refresh_feed(self):
+        """ Refreshes the feed, sets and returns feed_changed. Parsed
+            feed caches are keyed by the feeds mtime, so they are only
+            invalidated if the feed actually changed.
+        """
+        if not os.path.exists(self.feed_path):
+            self.feed_changed = \
+                self.download_feed_csv(retry_failed=True) is not None
+        else:
+            try:
+                csv_url = self.csv_url
+            except ET.ParseError:
+                csv_url = None
+            self.feed_changed = csv_url is not None and \
+                self._conditional_refresh(csv_url, self.feed_path,
+                                          'refresh_feed')
+        return self.feed_changed
 
     @property
     def shopinfo_str(self):
-        if not os.path.exists(self.path):
-            self.download_shopinfo_xml()
-        with open(self.path, 'rb') as f:
-            shopinfo_str = f.read()
-        return shopinfo_str
+        if not hasattr(self, '_shopinfo_str'):
+            if not os.path.exists(self.path):
+                self.download_shopinfo_xml()
+            with open(self.path, 'rb') as f:
+                self._shopinfo_str = f.read()
+        return self._shopinfo_str
 
     @property
     def root(self):
@@ -100,9 +280,8 @@ class Shopinfo:
 
     @property
     def encoding(self):
-        lines = self.shopinfo_str.split(b'\n')
-        p = re.compile(b'encoding="(?P<encoding>.*?)"')
-        m = p.search(lines[0])
+        first_line = self.shopinfo_str.split(b'\n', 1)[0]
+        m = self.encoding_pattern.search(first_line)
         if m is not None:
             return m.group('encoding').decode()
         return None
@@ -121,21 +300,25 @@ class Shopinfo:
 
     @property    
     def mappings(self):
+        if hasattr(self, '_mappings'):
+            return self._mappings
         cols = []
         mappings = self.tabular.find('Mappings')
-        if mappings is None:
-            # sometimes mappings is None
-            return cols
-        for mapping in mappings:
-            column_num = int(mapping.attrib['column'])
-            column_name = mapping.attrib['columnName']
-            column_type = mapping.attrib.get('type', column_name)
-            cols.append((column_num, column_name, column_type))
+        # sometimes mappings is None
+        if mappings is not None:
+            for mapping in mappings:
+                column_num = int(mapping.attrib['column'])
+                column_name = mapping.attrib['columnName']
+                column_type = mapping.attrib.get('type', column_name)
+                cols.append((column_num, column_name, column_type))
+        self._mappings = cols
         return cols
 
     @property
     def _column_lookup(self):
-        return {k: v for num, k, v in self.mappings}
+        if not hasattr(self, '_column_lookup_dict'):
+            self._column_lookup_dict = {k: v for num, k, v in self.mappings}
+        return self._column_lookup_dict
 
     @property
     def has_ean(self):
@@ -159,18 +342,22 @@ class Shopinfo:
             pass
         return csv_url
 
+    @property
+    def _special_chars(self):
+        if not hasattr(self, '_schars'):
+            self._schars = self.tabular.find('CSV/SpecialCharacters').attrib
+        return self._schars
+
     @property
     def csv_delimiter(self):
-        schars = self.tabular.find('CSV/SpecialCharacters').attrib
-        delimiter = schars['delimiter']
+        delimiter = self._special_chars['delimiter']
         if delimiter == '[tab]':
             delimiter = '\t'
         return delimiter
 
     @property
     def csv_lineend(self):
-        schars = self.tabular.find('CSV/SpecialCharacters').attrib
-        return schars.get('lineend')
+        return self._special_chars.get('lineend')
 
     @property
     def product_count(self):
@@ -193,54 +380,233 @@ class Shopinfo:
             categories.append((name, mapping, int(count)))
         return categories
 
-    def download_feed_csv(self):
-        if os.path.exists(self.feed_path):
+    @property
+    def meta(self):
+        if not hasattr(self, '_meta'):
+            self._meta = ShopinfoMeta.from_shopinfo(self)
+        return self._meta
+
+    @property
+    def feed_failed_path(self):
+        return self.feed_path + '.failed'
+
+    def _feed_failed(self, record, error):
+        self._failed(record, error, '{}: {} {}'.format(
+            error, self.url, self.shop_id))
+        with open(self.feed_failed_path, 'w') as f:
+            f.write('{}\n'.format(error))
+
+    def download_feed_csv(self, retry_failed=False):
+        """ Downloads the feed into a .part file which is renamed to
+            feed_path once complete. An existing .part file from an
+            interrupted download is resumed with a range request if the
+            feed didn't change in between. Failures are recorded in a
+            .failed file next to the feed and None is returned. Processes
+            downloading the same feed wait for each other on the stores
+            lock.
+        """
+        if self.store.lookup(self.feed_path):
             return self.feed_path
-        if not os.path.exists(self.feed_dir):
-            os.makedirs(self.feed_dir)
-        try:
-            r = requests.get(self.csv_url, stream=True)
-            with open(self.feed_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=1024):
-                    if chunk: # filter out keep-alive new chunks
-                        f.write(chunk)
-                        f.flush()
-        except requests.exceptions.ConnectionError:
-            print('connection aborted: {} {}'.format(
-                self.url, self.shop_id))
-        except requests.exceptions.MissingSchema:
-            print('missing schema: {} {}'.format(
-                self.url, self.shop_id))
-        except TypeError:
-            print('something broken: {} {}'.format(
-                self.url, self.shop_id))
-        # touch file
-        with open(self.feed_path, 'a'):
-            os.utime(self.feed_path, None)
+        if os.path.exists(self.feed_failed_path) and not retry_failed \
+                and not self._resumable():
+            return None
+        with self.store.lock(self.feed_path):
+            if not os.path.exists(self.feed_path):
+                self._download_feed_csv()
+        if not os.path.exists(self.feed_path):
+            return None
+        if os.path.exists(self.feed_failed_path):
+            os.remove(self.feed_failed_path)
         return self.feed_path
 
+    # failures which leave a .part behind that can be resumed
+    resumable_failures = ('connection aborted', 'download interrupted',
+                          'timeout')
+
+    def _resumable(self):
+        """ True if the feed failed while downloading and its .part can
+            be resumed, so the download isn't given up """
+        part_path = self.feed_path + '.part'
+        if not os.path.exists(part_path) or \
+                self._part_validator(part_path) is None:
+            return False
+        with open(self.feed_failed_path, 'r') as f:
+            return f.read().strip() in self.resumable_failures
+
+    def _part_validator(self, part_path):
+        """ ETag or Last-Modified of the response a .part was started
+            from, None if it can't be resumed safely """
+        try:
+            with open(part_path + '.validators', 'r') as f:
+                validators = json.load(f)
+        except (IOError, ValueError):
+            return None
+        etag = validators.get('etag')
+        if etag and not etag.startswith('W/'):
+            # If-Range only works with strong etags
+            return etag
+        return validators.get('last_modified')
+
+    def _discard_part(self, part_path):
+        for path in (part_path, part_path + '.validators'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _request_feed(self, part_path):
+        """ Requests the feed, resuming an existing .part with a range
+            request. If-Range makes the server send the whole feed
+            instead if it changed since the .part was started.
+        """
+        headers = {'Accept-Encoding': 'gzip, deflate'}
+        offset = 0
+        if os.path.exists(part_path):
+            validator = self._part_validator(part_path)
+            if validator is None:
+                self._discard_part(part_path)
+            else:
+                # byte ranges refer to the uncompressed representation
+                # only if we don't ask for a compressed one
+                offset = os.path.getsize(part_path)
+                headers = {'Accept-Encoding': 'identity',
+                           'Range': 'bytes={}-'.format(offset),
+                           'If-Range': validator}
+        r = self.http.get(self.csv_url, stream=True, headers=headers,
+                          timeout=(10, 60))
+        return r, offset
+
+    def _download_feed_csv(self):
+        part_path = self.feed_path + '.part'
+        with self._stage('feed') as record:
+            try:
+                for _ in range(2):
+                    r, offset = self._request_feed(part_path)
+                    content_range = r.headers.get('Content-Range', '')
+                    if r.status_code == 416 or (
+                            r.status_code == requests.codes.partial_content
+                            and not content_range.startswith(
+                                'bytes {}-'.format(offset))):
+                        # the feed shrank or the server sent another
+                        # range, start over without the .part
+                        r.close()
+                        self._discard_part(part_path)
+                        continue
+                    break
+                if r.status_code not in (requests.codes.ok,
+                                         requests.codes.partial_content):
+                    r.close()
+                    self._feed_failed(record, 'http {}'.format(r.status_code))
+                    return
+                if r.status_code == requests.codes.ok:
+                    # a fresh download, remember what it is a part of
+                    mode = 'wb'
+                    with open(part_path + '.validators', 'w') as f:
+                        json.dump({
+                            'etag': r.headers.get('ETag'),
+                            'last_modified': r.headers.get('Last-Modified'),
+                        }, f)
+                else:
+                    mode = 'ab'
+                with open(part_path, mode) as f:
+                    for chunk in r.iter_content(
+                            chunk_size=self.download_chunk_size):
+                        if chunk: # filter out keep-alive new chunks
+                            f.write(chunk)
+                            record.bytes += len(chunk)
+                os.replace(part_path, self.feed_path)
+                os.remove(part_path + '.validators')
+                self._save_validators(self.feed_path, r)
+                self.store.added(self.feed_path)
+            except requests.exceptions.ConnectionError:
+                self._feed_failed(record, 'connection aborted')
+            except requests.exceptions.ChunkedEncodingError:
+                self._feed_failed(record, 'download interrupted')
+            except requests.exceptions.Timeout:
+                self._feed_failed(record, 'timeout')
+            except requests.exceptions.MissingSchema:
+                self._feed_failed(record, 'missing schema')
+            except TypeError:
+                self._feed_failed(record, 'something broken')
+            except (requests.exceptions.RequestException,
+                    ET.ParseError) as e:
+                # invalid schema or url, too many redirects, broken
+                # encoding, a csv url which can't be parsed, ...
+                self._feed_failed(record, e.__class__.__name__)
+
+    @staticmethod
+    def _object_columns_as_str(df):
+        # inferred object columns often mix ints and strs, which can't
+        # be stored columnar, missing values stay NaN
+        return df.assign(**{
+            col: df[col].where(df[col].isnull(), df[col].astype(str))
+            for col in df.columns[df.dtypes == object]})
+
+    def _write_parsed(self, df, record):
+        # remove stale versions of this shops parsed feed
+        stale = glob.glob(self.store.path(self.shop_key, '.*.feather'))
+        for path in stale:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        tmp_path = '{}.{}.tmp'.format(self.parsed_path, os.getpid())
+        try:
+            df.reset_index(drop=True).to_feather(tmp_path)
+            os.replace(tmp_path, self.parsed_path)
+            self.store.added(self.parsed_path)
+        except (TypeError, ValueError):
+            # mixed type object columns can't be stored columnar
+            self._failed(record, 'not cacheable',
+                         'not cacheable: {}'.format(self.feed_path))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
     @property
     def dataframe(self):
-        if not os.path.exists(self.feed_path):
-            if not os.path.exists(self.feed_dir):
-                os.makedirs(self.feed_dir)
-            self.download_feed_csv()
+        if self.download_feed_csv() is None:
+            return None
+
+        with self._stage('parse') as record:
+            record.bytes = os.path.getsize(self.feed_path)
+            if self.store.lookup(self.parsed_path):
+                df = pd.read_feather(self.parsed_path)
+            else:
+                df = self._parse_dataframe(record)
+                if df is not None:
+                    df = self._object_columns_as_str(df)
+                    self._write_parsed(df, record)
+            if df is not None:
+                record.rows_parsed = len(df)
+        return df
 
+    def _parse_dataframe(self, record=None):
+        record = record or StageRecord()
         df = None
+        dialect = self.sniff_dialect()
+        record.encoding_fallback = \
+            dialect['encoding'] != (self.encoding or 'utf8')
         try:
-            df = pd.read_csv(self.feed_path, delimiter=self.csv_delimiter,
-                             encoding=self.encoding, error_bad_lines=False)
+            df = pd.read_csv(self.feed_path, error_bad_lines=False,
+                             **self._csv_options(dialect))
+            if record.encoding_fallback and self.metrics is None:
+                print('{}: {} {}'.format(
+                    dialect['encoding'], self.feed_path, df.shape))
         except UnicodeDecodeError:
+            record.encoding_fallback = True
             try:
                 df = pd.read_csv(self.feed_path, delimiter=self.csv_delimiter,
                                  encoding='latin1', error_bad_lines=False)
-                print('latin1: {} {}'.format(self.feed_path, df.shape))
+                if self.metrics is None:
+                    print('latin1: {} {}'.format(self.feed_path, df.shape))
             except UnicodeDecodeError:
-                print('UnicodeDecodeError: {}'.format(self.feed_path))
-        except pd.parser.CParserError:
-            print('pandas parser error: {}'.format(self.feed_path))
-        except ValueError:
-            print('pandas no columns to parse error: {}'.format(self.feed_path))
+                self._failed(record, 'UnicodeDecodeError',
+                             'UnicodeDecodeError: {}'.format(self.feed_path))
+        except pd.errors.ParserError:
+            self._failed(record, 'pandas parser error',
+                         'pandas parser error: {}'.format(self.feed_path))
+        except (pd.errors.EmptyDataError, ValueError):
+            self._failed(record, 'pandas no columns to parse error',
+                         'pandas no columns to parse error: {}'.format(
+                             self.feed_path))
         if df is not None:
             df.rename(columns=self._column_lookup, inplace=True)
             if "'" in df.columns[0]:
@@ -257,10 +623,201 @@ class Shopinfo:
     def valid_ean_df(self):
         df = self.dataframe
         if df is not None:
-            df.ean = df.ean.apply(self.ean.norm_or_nan)
-            df = df[~df.ean.isnull()]
+            with self._stage('ean') as record:
+                record.rows_parsed = len(df)
+                df.ean, valid = self.ean.norm_array(df.ean)
+                df = df[valid]
+                record.rows_kept = len(df)
         return df
 
+    @property
+    def dialect_path(self):
+        return self.feed_path + '.dialect'
+
+    def _decodes(self, data, encoding, blocksize=2 ** 20):
+        """ Checks blockwise if data (e.g. a mmap) decodes with encoding """
+        try:
+            decoder = codecs.getincrementaldecoder(encoding)()
+        except LookupError:
+            return False
+        try:
+            for start in range(0, len(data), blocksize):
+                decoder.decode(data[start:start + blocksize])
+            decoder.decode(b'', final=True)
+        except UnicodeDecodeError:
+            return False
+        return True
+
+    def _sniff_encoding(self, data):
+        if data[:3] == codecs.BOM_UTF8:
+            return 'utf-8-sig'
+        for encoding in (self.encoding, 'utf8'):
+            # a bounded prefix can't see a bad byte near the end, so
+            # the candidate is checked by decoding the whole mmap, which
+            # is much cheaper than parsing it a second time
+            if encoding is not None and self._decodes(data, encoding):
+                return encoding
+        return 'latin1'
+
+    def _sniff_delimiter(self, lines):
+        declared = self.csv_delimiter
+        for delimiter in [declared] + [d for d in self.sniff_delimiters
+                                       if d != declared]:
+            # number of fields per line, respecting quoted delimiters
+            counts = [len(row) for row in csv.reader(
+                lines, delimiter=delimiter)]
+            if counts and counts[0] > 1 and \
+                    counts.count(counts[0]) >= 0.8 * len(counts):
+                return delimiter
+        return declared
+
+    def sniff_dialect(self):
+        """ Picks encoding, delimiter, quoting and line ending from a
+            memory mapped, bounded prefix of the feed before the real
+            parse. The result is stored next to the feed and reused as
+            long as the feed and the shopinfo declarations don't change.
+        """
+        stat = os.stat(self.feed_path)
+        key = [stat.st_size, stat.st_mtime_ns, self.encoding,
+               self.csv_delimiter]
+        try:
+            with open(self.dialect_path, 'r') as f:
+                dialect = json.load(f)
+            if dialect.get('key') == key:
+                return dialect
+        except (IOError, ValueError):
+            pass
+
+        dialect = {'key': key, 'encoding': self.encoding or 'utf8',
+                   'delimiter': self.csv_delimiter, 'quotechar': '"',
+                   'lineterminator': None}
+        if stat.st_size > 0:
+            with open(self.feed_path, 'rb') as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                dialect['encoding'] = self._sniff_encoding(data)
+                prefix = data[:self.sniff_size]
+            # only look at complete lines
+            cut = max(prefix.rfind(b'\n'), prefix.rfind(b'\r'))
+            if cut > 0 and len(prefix) == self.sniff_size:
+                prefix = prefix[:cut]
+            if b'\r' in prefix and b'\n' not in prefix:
+                dialect['lineterminator'] = '\r'
+            sample = prefix.decode(dialect['encoding'], errors='replace')
+            lines = [line for line in sample.splitlines() if line][:50]
+            dialect['delimiter'] = self._sniff_delimiter(lines)
+            try:
+                quotechar = csv.Sniffer().sniff(
+                    sample, delimiters=dialect['delimiter']).quotechar
+                if quotechar in ('"', "'"):
+                    dialect['quotechar'] = quotechar
+            except csv.Error:
+                pass
+        self.store.write(self.dialect_path, json.dumps(dialect).encode('utf8'))
+        return dialect
+
+    def _csv_options(self, dialect):
+        options = {
+            'encoding': dialect['encoding'],
+            'delimiter': dialect['delimiter'],
+            'quotechar': dialect['quotechar'],
+        }
+        if dialect['lineterminator'] is not None:
+            options['lineterminator'] = dialect['lineterminator']
+        return options
+
+    def _projected_columns(self, options):
+        """ Maps the raw feed header to our column names for all columns
+            we keep, using the shopinfo mappings.
+        """
+        header = pd.read_csv(self.feed_path, nrows=0, **options).columns
+        projected = {}
+        for raw in header:
+            col = self._column_lookup.get(raw, raw).replace("'", "")
+            if col in self.columns and col not in projected.values():
+                projected[raw] = col
+        return projected
+
+    def iter_dataframe(self, chunksize=None, valid_ean=True):
+        """ Streams the feed in chunks of at most `chunksize` rows, reading
+            only the mapped columns we keep. With `valid_ean` only rows
+            with a valid ean are yielded.
+        """
+        if not os.path.exists(self.feed_path):
+            if self.download_feed_csv() is None:
+                return
+        chunksize = chunksize or self.chunksize
+        with self._stage('parse') as record:
+            record.bytes = os.path.getsize(self.feed_path)
+            record.rows_parsed = record.rows_kept = 0
+            try:
+                options = self._csv_options(self.sniff_dialect())
+                projected = self._projected_columns(options)
+                reader = pd.read_csv(
+                    self.feed_path, error_bad_lines=False, **options,
+                    usecols=list(projected),
+                    dtype={raw: self.dtypes[col]
+                           for raw, col in projected.items()},
+                    chunksize=chunksize)
+                for df in reader:
+                    record.rows_parsed += len(df)
+                    df.rename(columns=projected, inplace=True)
+                    for col in self.columns:
+                        if col not in df:
+                            df[col] = np.nan
+                    df = df[self.columns]
+                    if valid_ean:
+                        df.ean, valid = self.ean.norm_array(df.ean)
+                        df = df[valid]
+                    record.rows_kept += len(df)
+                    yield df
+            except pd.errors.ParserError:
+                self._failed(record, 'pandas parser error',
+                             'pandas parser error: {}'.format(self.feed_path))
+            except (pd.errors.EmptyDataError, ValueError):
+                self._failed(record, 'pandas no columns to parse error',
+                             'pandas no columns to parse error: {}'.format(
+                                 self.feed_path))
+
+
+class ShopinfoMeta:
+    """Compact, parsed once metadata of a shopinfo.xml.
+
+    Fields which are missing or broken in the xml are None.
+    """
+    __slots__ = (
+        'shop_id', 'url', 'name', 'shop_url', 'csv_url', 'delimiter',
+        'lineend', 'encoding', 'mappings', 'has_ean', 'product_count',
+        'categories',
+    )
+
+    def __init__(self, **fields):
+        for field in self.__slots__:
+            setattr(self, field, fields.get(field))
+
+    @classmethod
+    def from_shopinfo(cls, shopinfo):
+        def get(attr):
+            try:
+                return getattr(shopinfo, attr)
+            except (AttributeError, KeyError, TypeError, ValueError,
+                    ET.ParseError):
+                return None
+
+        return cls(
+            shop_id=shopinfo.shop_id, url=shopinfo.url, name=get('name'),
+            shop_url=get('shop_url'), csv_url=get('csv_url'),
+            delimiter=get('csv_delimiter'), lineend=get('csv_lineend'),
+            encoding=get('encoding'), mappings=get('mappings'),
+            has_ean=get('has_ean'), product_count=get('product_count'),
+            categories=get('categories'))
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __repr__(self):
+        return '<ShopinfoMeta {} {}>'.format(self.shop_id, self.name)
+
+
 class ShopinfoWorker(Thread):
     def __init__(self, queue):
         Thread.__init__(self)
@@ -269,8 +826,15 @@ class ShopinfoWorker(Thread):
     def run(self):
         while True:
             shopinfo, method_name = self.queue.get()
-            result = getattr(shopinfo, method_name)()
-            self.queue.task_done()
+            try:
+                getattr(shopinfo, method_name)()
+            except Exception as e:
+                # recorded by the metrics stage, if any, keep working
+                if shopinfo.metrics is None:
+                    print('{}: {} {}'.format(
+                        e.__class__.__name__, shopinfo.url, shopinfo.shop_id))
+            finally:
+                self.queue.task_done()
 
 
 def start_workers(queue, num=10):
@@ -279,21 +843,55 @@ def start_workers(queue, num=10):
         worker.daemon = True
         worker.start()
 
-def get_shopinfos_from_urls(shopinfo_urls):
+def _detach_metrics(shopinfos):
+    # the collector holds a lock, returned shopinfos have to stay
+    # picklable for process pools
+    for shopinfo in shopinfos:
+        shopinfo.metrics = None
+
+def get_shopinfos_from_urls(shopinfo_urls, metrics=None):
     queue = Queue()
     start_workers(queue)
     shopinfos = []
     for shopinfo_url in shopinfo_urls:
-        shopinfo = Shopinfo(shopinfo_url)
+        shopinfo = Shopinfo(shopinfo_url, metrics=metrics)
         queue.put((shopinfo, 'download_shopinfo_xml'))
         shopinfos.append(shopinfo)
     queue.join()
+    _detach_metrics(shopinfos)
     return shopinfos
 
-def get_feed_for_shopinfos(shopinfos):
+def get_feed_for_shopinfos(shopinfos, metrics=None):
     queue = Queue()
     start_workers(queue)
     for shopinfo in shopinfos:
+        if metrics is not None:
+            shopinfo.metrics = metrics
         queue.put((shopinfo, 'download_feed_csv'))
     queue.join()
+    _detach_metrics(shopinfos)
     return shopinfos
+
+def refresh_shopinfos(shopinfos, metrics=None):
+    """ Conditionally refreshes shopinfo xmls, returns the changed ones """
+    queue = Queue()
+    start_workers(queue)
+    for shopinfo in shopinfos:
+        if metrics is not None:
+            shopinfo.metrics = metrics
+        queue.put((shopinfo, 'refresh_shopinfo_xml'))
+    queue.join()
+    _detach_metrics(shopinfos)
+    return [s for s in shopinfos if getattr(s, 'shopinfo_changed', False)]
+
+def refresh_feeds(shopinfos, metrics=None):
+    """ Conditionally refreshes feeds, returns the shops whose feed changed """
+    queue = Queue()
+    start_workers(queue)
+    for shopinfo in shopinfos:
+        if metrics is not None:
+            shopinfo.metrics = metrics
+        queue.put((shopinfo, 'refresh_feed'))
+    queue.join()
+    _detach_metrics(shopinfos)
+    return [s for s in shopinfos if getattr(s, 'feed_changed', False)]
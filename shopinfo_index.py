@@ -0,0 +1,83 @@
+import json
+import sqlite3
+
+from shopinfo import ShopinfoMeta
+
+
+class ShopinfoIndex:
+    """Persisted index of shopinfo metadata backed by sqlite.
+
+    Allows queries over all crawled shops without touching any xml, e.g.
+    all shops with an ean column and more than n products.
+    """
+    json_fields = ('mappings', 'categories')
+
+    def __init__(self, path='shopinfos.sqlite'):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS shopinfo ({})'.format(', '.join(
+                '{} PRIMARY KEY'.format(field) if field == 'url' else field
+                for field in ShopinfoMeta.__slots__)))
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS shopinfo_products '
+            'ON shopinfo (has_ean, product_count)')
+        self.conn.commit()
+
+    def _to_row(self, meta):
+        row = meta.as_dict()
+        for field in self.json_fields:
+            row[field] = json.dumps(row[field])
+        return [row[field] for field in ShopinfoMeta.__slots__]
+
+    def _from_row(self, row):
+        fields = dict(zip(ShopinfoMeta.__slots__, row))
+        for field in self.json_fields:
+            value = json.loads(fields[field])
+            if value is not None:
+                value = [tuple(item) for item in value]
+            fields[field] = value
+        if fields['has_ean'] is not None:
+            fields['has_ean'] = bool(fields['has_ean'])
+        return ShopinfoMeta(**fields)
+
+    def add(self, metas):
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO shopinfo VALUES ({})'.format(
+                ', '.join('?' * len(ShopinfoMeta.__slots__))),
+            (self._to_row(meta) for meta in metas))
+        self.conn.commit()
+
+    def add_shopinfos(self, shopinfos):
+        self.add(shopinfo.meta for shopinfo in shopinfos)
+
+    def query(self, has_ean=None, min_products=None, with_csv_url=False):
+        """ Returns metadata of all shops matching the given filters,
+            min_products is exclusive.
+        """
+        where, params = [], []
+        if has_ean is not None:
+            where.append('has_ean = ?')
+            params.append(int(has_ean))
+        if min_products is not None:
+            where.append('product_count > ?')
+            params.append(min_products)
+        if with_csv_url:
+            where.append('csv_url IS NOT NULL')
+        sql = 'SELECT * FROM shopinfo'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY shop_id'
+        return [self._from_row(row) for row in self.conn.execute(sql, params)]
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM shopinfo').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def build_index(shopinfos, path='shopinfos.sqlite'):
+    index = ShopinfoIndex(path)
+    index.add_shopinfos(shopinfos)
+    return index
@@ -0,0 +1,172 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from products import as_text, convert_prices, offer_keys
+
+
+# columns whose changes make an offer "text changed" and need rematching
+text_columns = ['name', 'shortdescription', 'brand', 'type', 'ean']
+
+
+def _row_hashes(df, columns):
+    # hash the feed text, not the dtype read_csv happened to infer
+    columns = [c for c in columns if c in df]
+    text = pd.DataFrame({c: as_text(df[c]).to_numpy() for c in columns},
+                        index=df.index)
+    return pd.util.hash_pandas_object(
+        text, index=False, categorize=False).to_numpy(dtype=np.uint64)
+
+
+def _price_hashes(df):
+    # '1,00' and 1.0 are the same price, feeds repeat few distinct prices
+    # so only those are converted
+    if 'price' in df:
+        codes, uniques = pd.factorize(df.price)
+        prices = np.append(convert_prices(uniques).to_numpy(dtype=float),
+                           np.nan)[codes]
+    else:
+        prices = np.full(len(df), np.nan)
+    return pd.util.hash_array(prices, categorize=False)
+
+
+class Delta:
+    """What changed in a shops feed since its last snapshot.
+
+    `new`, `price_changed` and `text_changed` hold the offers as in the
+    new feed (with their `key`), `removed` the keys which vanished.
+    `changed` are the offers which need (re)matching.
+    """
+    def __init__(self, new, removed, price_changed, text_changed):
+        self.new = new
+        self.removed = removed
+        self.price_changed = price_changed
+        self.text_changed = text_changed
+
+    @property
+    def changed(self):
+        return pd.concat([self.new, self.text_changed])
+
+    def counts(self):
+        return {'new': len(self.new), 'removed': len(self.removed),
+                'price_changed': len(self.price_changed),
+                'text_changed': len(self.text_changed)}
+
+    def __len__(self):
+        return sum(self.counts().values())
+
+    def __repr__(self):
+        return '<Delta {}>'.format(' '.join(
+            '{}={}'.format(k, v) for k, v in self.counts().items()))
+
+
+def snapshot_frame(shop, df):
+    """ The offers of a feed with their key and content hashes, one row
+        per key (the last one wins for duplicate keys).
+    """
+    df = df.assign(shop=shop)
+    keys = offer_keys(df)
+    df = df.assign(key=keys.to_numpy(),
+                   key_hash=pd.util.hash_array(keys.to_numpy(dtype=object),
+                                               categorize=False))
+    df = df.drop_duplicates('key_hash', keep='last').reset_index(drop=True)
+    df['text_hash'] = _row_hashes(df, text_columns)
+    df['price_hash'] = _price_hashes(df)
+    return df
+
+
+def diff(old, new):
+    """ Delta between two snapshot frames, joined on the key hashes """
+    old_pos = pd.Index(old.key_hash).get_indexer(new.key_hash)
+    known = old_pos >= 0
+    new_pos = np.flatnonzero(known)
+    old_pos = old_pos[known]
+    text_changed = old.text_hash.to_numpy()[old_pos] != \
+        new.text_hash.to_numpy()[new_pos]
+    price_changed = old.price_hash.to_numpy()[old_pos] != \
+        new.price_hash.to_numpy()[new_pos]
+    removed = np.ones(len(old), dtype=bool)
+    removed[old_pos] = False
+    return Delta(new=new[~known], removed=old.key[removed],
+                 price_changed=new.iloc[new_pos[price_changed]],
+                 text_changed=new.iloc[new_pos[text_changed]])
+
+
+class SnapshotStore:
+    """Last seen state of each shops feed and the price history.
+
+    `refresh` compares a freshly parsed feed with the shops snapshot,
+    replaces the snapshot and returns a `Delta`, so indexes and matching
+    only need to look at the changed offers. Prices of new and price
+    changed offers are appended to `history/<shop>.csv`.
+    """
+    snapshot_columns = ['key', 'key_hash', 'text_hash', 'price_hash']
+
+    def __init__(self, root='snapshots'):
+        self.root = root
+        for directory in ('current', 'history'):
+            path = os.path.join(root, directory)
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+    def snapshot_path(self, shop):
+        return os.path.join(self.root, 'current', '{}.feather'.format(shop))
+
+    def history_path(self, shop):
+        return os.path.join(self.root, 'history', '{}.csv'.format(shop))
+
+    def snapshot(self, shop):
+        path = self.snapshot_path(shop)
+        if not os.path.exists(path):
+            return pd.DataFrame({
+                'key': pd.Series(dtype=object),
+                'key_hash': pd.Series(dtype=np.uint64),
+                'text_hash': pd.Series(dtype=np.uint64),
+                'price_hash': pd.Series(dtype=np.uint64)})
+        return pd.read_feather(path)
+
+    def _write_snapshot(self, shop, current):
+        path = self.snapshot_path(shop)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        current[self.snapshot_columns].to_feather(tmp_path)
+        os.replace(tmp_path, path)
+
+    def _append_history(self, shop, offers, timestamp):
+        if len(offers) == 0:
+            return
+        history = pd.DataFrame({
+            'timestamp': timestamp,
+            'key': offers.key.to_numpy(),
+            'price': convert_prices(offers.price).to_numpy(),
+        })
+        path = self.history_path(shop)
+        history.to_csv(path, mode='a', index=False,
+                       header=not os.path.exists(path))
+
+    def refresh(self, shop, df, timestamp=None):
+        """ Diffs the offers in df against the shops snapshot, stores
+            df as the new snapshot and returns the Delta.
+        """
+        timestamp = timestamp if timestamp is not None else int(time.time())
+        current = snapshot_frame(shop, df)
+        delta = diff(self.snapshot(shop), current)
+        self._append_history(
+            shop, pd.concat([delta.new, delta.price_changed]), timestamp)
+        self._write_snapshot(shop, current)
+        return delta
+
+    def refresh_shopinfo(self, shopinfo, timestamp=None):
+        """ refresh with the valid ean offers of a (refreshed) shopinfo,
+            None if its feed couldn't be parsed """
+        df = shopinfo.valid_ean_df
+        if df is None:
+            return None
+        return self.refresh(shopinfo.shop_key, df, timestamp=timestamp)
+
+    def price_history(self, shop, key=None):
+        history = pd.read_csv(self.history_path(shop))
+        if key is not None:
+            history = history[history.key == key]
+        return history
@@ -0,0 +1,173 @@
+import os
+import time
+import fcntl
+import pickle
+import hashlib
+import functools
+
+from contextlib import contextmanager
+from threading import Lock
+
+
+def key_for(value):
+    return hashlib.sha1(str(value).encode('utf8')).hexdigest()
+
+
+class ArtifactStore:
+    """On-disk store for downloaded and derived artifacts.
+
+    Artifacts are addressed by a key (e.g. the hash of an url) instead of
+    a crawl order dependent number, so runs can reuse them in any order.
+    All files of an entry share the key as filename stem
+    (`<key>.xml`, `<key>.csv`, `<key>.csv.validators`, ...) and are
+    evicted together, least recently used first, once the store grows
+    beyond `max_bytes`. Writes go through a temporary file and an atomic
+    rename and `lock` serializes work on an entry across processes.
+    """
+    def __init__(self, root='store', max_bytes=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = None
+        self._lock = Lock()
+
+    def __getstate__(self):
+        # stores are passed to worker processes, which count on their own
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = Lock()
+
+    def path(self, key, suffix=''):
+        directory = os.path.join(self.root, key[:2])
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, key + suffix)
+
+    def lookup(self, path):
+        """ Returns whether path exists, counting hits and misses, and
+            marks the entry as recently used. Only the access time is
+            touched, mtimes are used as cache keys elsewhere.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return False
+        os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+        with self._lock:
+            self.hits += 1
+        return True
+
+    @contextmanager
+    def lock(self, path):
+        """ Exclusive lock on an entry, shared between processes """
+        with open(path + '.lock', 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def write(self, path, data):
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.added(path)
+
+    def added(self, path):
+        """ Accounts a new file and evicts entries if over the cap """
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = self.size()
+            else:
+                try:
+                    self._size += os.path.getsize(path)
+                except OSError:
+                    pass
+            over = self._size > self.max_bytes
+        if over:
+            self.evict()
+
+    def _entries(self):
+        entries = {}
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                key = name.split('.', 1)[0]
+                size, used, paths = entries.get(key, (0, 0, []))
+                paths.append(path)
+                entries[key] = (size + stat.st_size,
+                                max(used, stat.st_atime), paths)
+        return entries
+
+    def size(self):
+        return sum(size for size, _, _ in self._entries().values())
+
+    def evict(self):
+        """ Removes least recently used entries until under the cap """
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, '.evict.lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            entries = self._entries()
+            entries.pop('', None)
+            total = sum(size for size, _, _ in entries.values())
+            for key, (size, _, paths) in sorted(
+                    entries.items(), key=lambda item: item[1][1]):
+                if total <= self.max_bytes:
+                    break
+                for path in paths:
+                    if path.endswith('.lock'):
+                        continue
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                total -= size
+                self.evictions += 1
+            fcntl.flock(f, fcntl.LOCK_UN)
+        with self._lock:
+            self._size = total
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else None,
+            'evictions': self.evictions,
+            'bytes': self.size(),
+        }
+
+    def cache(self, func):
+        """ Decorator memoizing func's (picklable) results in the store,
+            keyed by the function name and arguments.
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = key_for((func.__module__, func.__name__, args,
+                           sorted(kwargs.items())))
+            path = self.path(key, '.pickle')
+            if self.lookup(path):
+                with open(path, 'rb') as f:
+                    return pickle.load(f)
+            result = func(*args, **kwargs)
+            self.write(path, pickle.dumps(result))
+            return result
+        return wrapper
+
+
+default_store = ArtifactStore()
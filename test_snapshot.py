@@ -0,0 +1,33 @@
+from io import StringIO
+
+import pandas as pd
+
+from snapshot import SnapshotStore
+
+
+feed = '''privateid;name;brand;ean;price
+101;Kamera X100;Foto;4006381333931;"1,00"
+;Objektiv 50mm;Foto;4006381333948;"249,90"
+103;Stativ;Foto;4006381333955;19.99 EUR
+'''
+
+
+def read_feed(**kwargs):
+    return pd.read_csv(StringIO(feed), sep=';', **kwargs)
+
+
+def test_refresh_ignores_inferred_dtypes(tmp_path):
+    store = SnapshotStore(root=str(tmp_path))
+    as_str = read_feed(dtype=str)
+    inferred = read_feed()
+    assert inferred.privateid.dtype.kind == 'f'
+    assert inferred.ean.dtype.kind == 'i'
+
+    assert len(store.refresh('shop', as_str).new) == 3
+    delta = store.refresh('shop', inferred)
+    assert len(delta) == 0, delta
+
+    converted = inferred.assign(price=[1.0, 249.9, 19.99])
+    delta = store.refresh('shop', converted)
+    assert len(delta) == 0, delta
+    assert len(store.refresh('shop', as_str)) == 0
@@ -1,9 +1,14 @@
 import numpy as np
+import pandas as pd
 
 
 class Ean:
     _weights = (3, 1, 3, 1, 3, 1, 3, 1, 3, 1, 3, 1, 3, 1, 3, 1, 3)
 
+    # normalized eans have between 8 and len(_weights) + 1 digits
+    _min_ean = 10 ** 7
+    _max_ean = 10 ** (len(_weights) + 1)
+
     def check_ean(self, ean):
         """ Checks if the given EAN is valid, i.e. well-formed and up to
             the checksum test.
@@ -23,7 +28,7 @@ class Ean:
         offset = len(self._weights) - len(ean_digits)
         checksum = sum([self._weights[offset+i] * ean_digits[i] \
                          for i in range(0, len(ean_digits)) ])
-        next_ten = int(checksum) / 10
+        next_ten = int(checksum) // 10
         if int(checksum) % 10: next_ten += 1
         next_ten *= 10
         check_digit = next_ten - checksum
@@ -37,3 +42,54 @@ class Ean:
         if not self.check_ean(norm_ean):
             return np.nan
         return norm_ean
+
+    @staticmethod
+    def _float_or_nan(value):
+        try:
+            return float(value)
+        except ValueError:
+            return np.nan
+
+    def parse_array(self, eans):
+        """ Parses a whole column of eans to int64 the same way
+            norm_or_nan does for a single value. Returns the integers
+            and a mask of the values which are in the range of
+            well-formed eans.
+        """
+        eans = pd.Series(eans)
+        if eans.dtype.kind not in 'iuf':
+            strings = eans.astype(str).str.replace(' ', '', regex=False)
+            eans = pd.to_numeric(strings, errors='coerce')
+            # pandas' fast float parser may round differently from float()
+            # for long or huge values, so reparse those few the slow way
+            inexact = ((strings.str.len() > 15) |
+                       (eans.abs() >= 2 ** 53)).to_numpy()
+            if inexact.any():
+                eans = eans.astype(np.float64)
+                eans[inexact] = [self._float_or_nan(s) for s in strings[inexact]]
+        values = np.trunc(eans.to_numpy(dtype=np.float64, na_value=np.nan))
+        in_range = (values >= self._min_ean) & (values < self._max_ean)
+        ints = np.where(in_range, values, 0).astype(np.int64)
+        return ints, in_range
+
+    def check_array(self, ints):
+        """ Vectorized checksum test over an int64 array of eans. """
+        rest, check_digit = np.divmod(np.asarray(ints, dtype=np.int64), 10)
+        checksum = np.zeros_like(rest)
+        for weight in self._weights[::-1]:
+            rest, digit = np.divmod(rest, 10)
+            checksum += weight * digit
+        return (10 - checksum % 10) % 10 == check_digit
+
+    def norm_array(self, eans):
+        """ Normalizes a Series/ndarray of eans at once. Returns a
+            series of normalized ean strings (nan for invalid eans, like
+            norm_or_nan) and the validity mask.
+        """
+        eans = pd.Series(eans)
+        ints, valid = self.parse_array(eans)
+        valid &= self.check_array(ints)
+        normalized = np.full(len(ints), np.nan, dtype=object)
+        normalized[valid] = ints[valid].astype(str)
+        return (pd.Series(normalized, index=eans.index),
+                pd.Series(valid, index=eans.index))